@@ -0,0 +1,286 @@
+"""
+Search benchmarks against a reproducible synthetic directory.
+
+:func:`run` fills the database with a generated corpus of profiles, groups,
+skills and tasks (the same corpus for the same ``profiles`` and ``seed``),
+sends a fixed mix of queries through ``UserProfile.search``, ``Task.search``
+and ``Group.search``/``Skill.search`` and reports latency percentiles and the
+number of database queries each call issued.  Everything it creates is rolled
+back afterwards.
+
+With ElasticSearch disabled (or ``backend='local'``) searches go to the
+in-process index from :mod:`common.search`; with ``backend='es'`` the corpus
+is bulk loaded into a scratch index that is deleted when the run ends.
+"""
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+
+from common import indexing, search
+
+FIRST_NAMES = (u'Aaron', u'Aisha', u'Akash', u'Amanda', u'Andrea', u'Ben',
+               u'Carlos', u'Chen', u'Daniela', u'David', u'Elena', u'Emma',
+               u'Fatima', u'Gabriel', u'Hiroshi', u'Ioana', u'James', u'Jia',
+               u'John', u'Julia', u'Kai', u'Laura', u'Lucas', u'Maria',
+               u'Matt', u'Mohamed', u'Nina', u'Olga', u'Pedro', u'Priya',
+               u'Rahul', u'Sara', u'Sofia', u'Tom', u'Wei', u'Yuki')
+LAST_NAMES = (u'Ahmed', u'Brown', u'Chen', u'Costa', u'Davis', u'Garcia',
+              u'Ivanov', u'Johnson', u'Kim', u'Kumar', u'Lee', u'Martin',
+              u'Meyer', u'Moreau', u'Nguyen', u'Novak', u'Popescu', u'Rossi',
+              u'Sato', u'Schmidt', u'Silva', u'Smith', u'Tanaka', u'Wang',
+              u'Williams', u'Wilson', u'Yilmaz', u'Zhang')
+WORDS = (u'add-ons', u'support', u'firefox', u'thunderbird', u'marketing',
+         u'l10n', u'webdev', u'qa', u'security', u'design', u'research',
+         u'mobile', u'android', u'rust', u'python', u'javascript', u'css',
+         u'community', u'events', u'education', u'privacy', u'policy',
+         u'release', u'sumo', u'mdn', u'accessibility', u'performance')
+
+GROUPS = 500
+SKILLS = 300
+TASKS_PER_PROFILE = 0.05
+RUNS_PER_QUERY = 5
+
+# The per-field query UserProfile.search used before the combined
+# search_text/search_prefix fields; benchmarked with ``legacy=True``.
+LEGACY_SEARCH_FIELDS = ('first_name__text', 'last_name__text',
+                        'display_name__text', 'username__text', 'bio__text',
+                        'website__text', 'email__text', 'groups__text',
+                        'first_name__startswith', 'last_name__startswith',
+                        'ircname')
+
+
+def zipf_picker(rng, n, s=1.1):
+    """Return a function picking ranks ``0..n-1`` with Zipf(``s``) odds."""
+    weights = [1.0 / (rank + 1) ** s for rank in xrange(n)]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+
+    def pick():
+        x = rng.random()
+        lo, hi = 0, n - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumulative[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    return pick
+
+
+def generate_corpus(profiles, seed):
+    """
+    Create ``profiles`` users with profiles, groups, skills and tasks.
+
+    Rows are inserted with ``bulk_create`` so no signal handlers (and no
+    indexing) run.  Returns the generated group names for the query mix.
+    """
+    from groups.models import Group, Skill, change_member_counts
+    from taskboard.models import Task
+    from users.models import UserProfile
+
+    rng = random.Random(seed)
+    tag = '%d%d' % (seed, rng.randint(0, 10 ** 6))
+
+    def name(i):
+        # Tag names are unique, so they carry the run's tag.
+        return u'%s %s %s-%d' % (rng.choice(WORDS), rng.choice(WORDS), tag, i)
+
+    # Autocompleted, so Group.search and Skill.search find them.
+    Group.objects.bulk_create([Group(name=name(i), url='bench-%s-%d' %
+                                     (tag, i), auto_complete=True)
+                               for i in xrange(GROUPS)])
+    Skill.objects.bulk_create([Skill(name=name(i), auto_complete=True)
+                               for i in xrange(SKILLS)])
+    groups = list(Group.objects.filter(name__contains=tag).order_by('id'))
+    skills = list(Skill.objects.filter(name__contains=tag).order_by('id'))
+
+    pick_first = zipf_picker(rng, len(FIRST_NAMES), 0.7)
+    pick_last = zipf_picker(rng, len(LAST_NAMES), 0.7)
+    User.objects.bulk_create([
+        User(username='bench%s_%d' % (tag, i),
+             email='bench%s_%d@example.com' % (tag, i),
+             first_name=FIRST_NAMES[pick_first()],
+             last_name=LAST_NAMES[pick_last()])
+        for i in xrange(profiles)])
+    users = User.objects.filter(username__startswith='bench%s_' % tag)
+    UserProfile.objects.bulk_create([
+        UserProfile(user=u, display_name=u'%s %s' % (u.first_name,
+                                                     u.last_name),
+                    confirmation_code='%s%s' % (tag, u.id),
+                    is_vouched=rng.random() < 0.8,
+                    ircname=u.username[:63],
+                    bio=u' '.join(rng.choice(WORDS) for i in xrange(12)))
+        for u in users])
+    ids = list(UserProfile.objects.filter(user__in=users)
+                                  .values_list('id', flat=True))
+
+    pick_group = zipf_picker(rng, len(groups))
+    pick_skill = zipf_picker(rng, len(skills))
+    group_rows, skill_rows = set(), set()
+    for id in ids:
+        for i in xrange(rng.randint(0, 6)):
+            group_rows.add((id, groups[pick_group()].id))
+        for i in xrange(rng.randint(0, 8)):
+            skill_rows.add((id, skills[pick_skill()].id))
+    GroupThrough = UserProfile.groups.through
+    SkillThrough = UserProfile.skills.through
+    GroupThrough.objects.bulk_create([
+        GroupThrough(userprofile_id=p, group_id=g) for p, g in group_rows])
+    SkillThrough.objects.bulk_create([
+        SkillThrough(userprofile_id=p, skill_id=s) for p, s in skill_rows])
+    # bulk_create sends no m2m_changed, so set the counts it would have.
+    change_member_counts(Group, [g for p, g in group_rows], 1)
+    change_member_counts(Skill, [s for p, s in skill_rows], 1)
+
+    Task.objects.bulk_create([
+        Task(contact_id=rng.choice(ids),
+             summary=u'%s %s' % (rng.choice(WORDS).title(), rng.choice(WORDS)),
+             instructions=u' '.join(rng.choice(WORDS) for i in xrange(20)),
+             disabled=rng.random() < 0.1)
+        for i in xrange(int(profiles * TASKS_PER_PROFILE) or 1)])
+
+    return [g.name for g in groups]
+
+
+def query_mix(group_names):
+    """The fixed queries each search path is run with."""
+    full_names = [u'%s %s' % n for n in zip(FIRST_NAMES, LAST_NAMES)[:4]]
+    profile = ([n[:1] for n in FIRST_NAMES[:4]] +
+               [n[:3] for n in LAST_NAMES[:4]] + full_names +
+               [group_names[0], group_names[-1], u'nobody-matches-this'])
+    task = list(WORDS[:6]) + [u'%s %s' % (WORDS[0], WORDS[1]), u'zzz']
+    tag = [w[:n] for w in WORDS[:6] for n in (1, 2, 4)]
+    return profile, task, tag
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of the sorted list ``values``."""
+    if not values:
+        return 0.0
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def measure(fn, queries, runs):
+    timings = []
+    db_queries = 0
+    for query in queries:
+        for i in xrange(runs):
+            before = len(connection.queries)
+            start = time.time()
+            fn(query)
+            timings.append((time.time() - start) * 1000)
+            db_queries += len(connection.queries) - before
+    timings.sort()
+    calls = len(timings)
+    return {'calls': calls,
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'db_queries_per_call': round(float(db_queries) / calls, 2)}
+
+
+@contextmanager
+def search_backend(backend, models):
+    """Point searches at the local index or a scratch ES index."""
+    old_disabled = settings.ES_DISABLED
+    old_indexes = settings.ES_INDEXES
+    settings.ES_DISABLED = backend == 'local'
+    try:
+        if backend == 'local':
+            for model in models:
+                search.reset_index(model)
+            yield
+        else:
+            from elasticutils import get_es
+            name = '%s_benchmark' % old_indexes['default']
+            settings.ES_INDEXES = {'default': name}
+            indexing.create_index(name, models)
+            try:
+                for model in models:
+                    indexing.bulk_index(model, indexes=[name])
+                get_es().refresh(name)
+                yield
+            finally:
+                get_es().delete_index(name)
+    finally:
+        for model in models:
+            search.reset_index(model)
+        settings.ES_DISABLED = old_disabled
+        settings.ES_INDEXES = old_indexes
+
+
+def run(profiles=1000, seed=1, backend=None, runs=RUNS_PER_QUERY,
+        legacy=False):
+    """
+    Run the benchmark and return its report as a dict.
+
+    With ``legacy`` the profile queries are also sent as the per-field query
+    in :data:`LEGACY_SEARCH_FIELDS`, reported as ``UserProfile.search
+    (legacy)``.
+    """
+    from groups import autocomplete
+    from groups.models import Group, Skill
+    from taskboard.models import Task
+    from users.models import UserProfile
+
+    if backend is None:
+        backend = 'local' if settings.ES_DISABLED else 'es'
+
+    report = {'profiles': profiles, 'seed': seed, 'backend': backend,
+              'runs_per_query': runs, 'legacy': legacy}
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        start = time.time()
+        group_names = generate_corpus(profiles, seed)
+        report['corpus_seconds'] = round(time.time() - start, 2)
+        # Rebuild the autocomplete indexes with the corpus' names.
+        autocomplete.invalidate(Group)
+        autocomplete.invalidate(Skill)
+        profile_q, task_q, tag_q = query_mix(group_names)
+
+        with search_backend(backend, [UserProfile, Task]):
+            # Build the local index (or warm ES) outside the timings.
+            UserProfile.search(u'warm').count()
+            Task.search(u'warm').count()
+
+            def profile_search(q):
+                # What the search view does, minus the result cache.
+                search.fetch_page(UserProfile.search(q).values_dict(), 0, 20)
+
+            def legacy_search(q):
+                s = search.get_search(UserProfile).query(
+                    or_=dict((f, q) for f in LEGACY_SEARCH_FIELDS))
+                search.fetch_page(s.values_dict(), 0, 20)
+
+            results = report['results'] = {
+                'UserProfile.search': measure(profile_search, profile_q,
+                                              runs),
+                'Task.search': measure(lambda q: list(Task.search(q)[:20]),
+                                       task_q, runs),
+                'Group.search': measure(Group.search, tag_q, runs),
+                'Skill.search': measure(Skill.search, tag_q, runs),
+            }
+            if legacy:
+                results['UserProfile.search (legacy)'] = measure(
+                    legacy_search, profile_q, runs)
+    finally:
+        transaction.rollback()
+        transaction.leave_transaction_management()
+        connection.use_debug_cursor = old_debug_cursor
+        # Don't keep the rolled back names.
+        autocomplete.invalidate(Group)
+        autocomplete.invalidate(Skill)
+    return report
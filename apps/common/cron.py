@@ -34,7 +34,8 @@ def find_orphaned_files(path=''):
                 if issubclass(field.__class__, models.FileField):
                     model_dict[model].append(field)
 
-    # Get a list of all files referenced in the database.
+    # Get a list of all files referenced in the database, plus the files
+    # models derive from them (see UserProfile.derived_files).
     referenced = set()
     for model in model_dict.iterkeys():
         all = model.objects.all().iterator()
@@ -43,8 +44,59 @@ def find_orphaned_files(path=''):
                 f = getattr(object, field.name)
                 if f:
                     referenced.add(os.path.abspath(f.path))
+                    if hasattr(object, 'derived_files'):
+                        for name in object.derived_files(field.name):
+                            referenced.add(
+                                os.path.abspath(f.storage.path(name)))
 
     # Print each file that is not referenced in the database.
     for f in sorted(media - referenced):
         sys.stdout.write(f)
         sys.stdout.write('\n')
+
+
+@cronjobs.register
+def search_cache_stats():
+    """Print the search result cache's hit and miss counts."""
+    from common import searchcache
+
+    stats = searchcache.stats()
+    total = stats['hits'] + stats['misses']
+    ratio = float(stats['hits']) / total if total else 0.0
+    sys.stdout.write('hits: %(hits)d misses: %(misses)d' % stats)
+    sys.stdout.write(' hit ratio: %.2f\n' % ratio)
+
+
+@cronjobs.register
+def reindex(keep='1'):
+    """
+    Build a new versioned search index and swap the alias over to it.
+
+    ``keep`` is how many previous versions to leave in place for rollback.
+    """
+    from common import indexing
+    from taskboard.models import Task
+    from users.models import UserProfile
+
+    new, reports = indexing.reindex([UserProfile, Task], keep=int(keep))
+    for report in reports:
+        sys.stdout.write('%s\n' % report)
+    sys.stdout.write('%s is now live.\n' % new)
+
+
+@cronjobs.register
+def benchmark_search(profiles='1000', seed='1', backend=None, legacy=''):
+    """
+    Benchmark the search paths against a synthetic directory.
+
+    Prints a JSON report of latency percentiles and database queries per
+    call; ``backend`` is ``local`` or ``es`` (default: whichever is enabled).
+    Pass ``legacy`` to time the old per-field profile query as well.
+    """
+    import json
+
+    from common import benchmark
+
+    report = benchmark.run(profiles=int(profiles), seed=int(seed),
+                           backend=backend or None, legacy=bool(legacy))
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
@@ -0,0 +1,31 @@
+"""
+Generation counters kept in the cache.
+
+Cached things that can't be deleted one by one (search result pages, the
+in-process autocomplete indexes) carry the current generation of their
+counter in their key or next to them; bumping the counter makes all of them
+stale at once.
+"""
+from django.core.cache import cache
+
+#: Counters have to outlive whatever is cached under them.  A timeout of 0
+#: means the backend's default (five minutes), not "forever", and memcached
+#: takes anything over 30 days for a timestamp.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get(key):
+    """Return the current generation of the counter ``key``."""
+    gen = cache.get(key)
+    if gen is None:
+        cache.add(key, 1, GENERATION_TIMEOUT)
+        gen = cache.get(key) or 1
+    return gen
+
+
+def bump(key):
+    """Move the counter ``key`` on to its next generation."""
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, GENERATION_TIMEOUT)
@@ -1,24 +1,15 @@
-import logging
-import os
-
-from django.conf import settings
-
 from jingo import register
-from sorl.thumbnail import get_thumbnail
 
+from common import thumbnails
 
-logger = logging.getLogger('common.helpers')
 
 @register.function
-def thumbnail(source, *args, **kwargs):
-    """ Wraps sorl thumbnail with an additional 'default' keyword"""
-
-    # Templates should never return an exception
-    try:
-        if not source.path:
-            source = kwargs.get('default')
-        return get_thumbnail(source, *args, **kwargs)
-    except Exception as e:
-        logger.error('Thumbnail had Exception: %s' % (e,))
-        source = getattr(settings, 'DEFAULT_IMAGE_SRC')
-        return get_thumbnail(source, *args, **kwargs)
+def thumbnail(source, geometry, default=None, **options):
+    """
+    The pre-generated ``geometry`` thumbnail of ``source`` (or ``default``).
+
+    ``default`` is a name in the default storage, used when ``source`` is
+    empty.  Nothing is generated while the page renders; see
+    :mod:`common.thumbnails`.
+    """
+    return thumbnails.get(source or default, geometry, **options)
@@ -0,0 +1,580 @@
+"""
+Bulk (re)indexing of searchable models.
+
+Reindexing used to mean loading every id into memory and fanning out one
+celery task per 150 ids, each of which indexed its documents one at a time.
+:func:`bulk_index` instead walks the table in primary key order, builds the
+documents for one batch at a time and sends each batch to ElasticSearch as a
+single newline-delimited ``_bulk`` request.  The batch size follows the
+latency of those requests so a busy cluster gets smaller requests.
+:func:`reindex` uses it to build a fresh versioned index next to the live one
+and then swaps an alias over to it.
+
+Saves don't index anything directly either: they hand their ids to the
+:data:`coalescer`, which collects them for the length of a request (see
+:class:`common.middleware.IndexCoalescingMiddleware`) or a :func:`coalesced`
+block and then schedules one deduplicated task per model.  Adding or
+removing groups and skills doesn't save anything, so ``m2m_changed``
+receivers go through :func:`schedule_m2m_update` instead, which schedules
+only the changed fields of the affected documents (see
+:func:`update_fields`).
+"""
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+
+import commonware.log
+from elasticutils import get_es
+from pyes.exceptions import IndexMissingException, NotFoundException
+
+from common import searchcache
+
+log = commonware.log.getLogger('m.indexing')
+
+#: How long we'd like a single ``_bulk`` request to take, in seconds.
+BULK_TARGET_SECONDS = 1.0
+BULK_MIN_SIZE = 50
+BULK_MAX_SIZE = 2000
+BULK_START_SIZE = 200
+
+#: Index-wide settings; defines the analyzers models' mappings refer to.
+INDEX_SETTINGS = {
+    'analysis': {
+        'filter': {
+            'edge_ngram': {'type': 'edgeNGram', 'side': 'front',
+                           'min_gram': 1, 'max_gram': 20},
+        },
+        'analyzer': {
+            'edge_ngram': {'type': 'custom', 'tokenizer': 'standard',
+                           'filter': ['standard', 'lowercase',
+                                      'edge_ngram']},
+        },
+    },
+}
+
+#: While a reindex runs, the name of the index it builds is kept here.
+REINDEX_KEY = 'search:reindex:%s'
+REINDEX_TIMEOUT = 60 * 60 * 24
+
+#: Seconds a flushed batch waits before it is indexed, so a burst of saves
+#: from several processes has settled by the time the documents are built.
+INDEX_UPDATE_COUNTDOWN = 5
+
+
+def stream_ids(model, chunk_size=1000, queryset=None):
+    """
+    Yield the ids of ``model`` in ascending order.
+
+    Ids are read ``chunk_size`` at a time with a keyset query
+    (``id > last_id``), so neither the database nor this process ever holds
+    the whole id list.
+    """
+    if queryset is None:
+        queryset = model.objects.all()
+    qs = queryset.order_by('id').values_list('id', flat=True)
+    last = 0
+    while True:
+        ids = list(qs.filter(id__gt=last)[:chunk_size])
+        for id in ids:
+            yield id
+        if len(ids) < chunk_size:
+            return
+        last = ids[-1]
+
+
+def get_documents(model, ids, fields=None):
+    """
+    Return ``(id, document)`` pairs for every existing object in ``ids``.
+
+    Models that can build many documents at once provide an
+    ``index_documents(ids, fields=None)`` classmethod; everything else falls
+    back to calling ``fields()`` on each object.  With ``fields`` the
+    documents only hold those fields (and whatever is derived from them);
+    only models with ``index_documents`` support that, and they may return
+    ids that don't exist, which :func:`update_fields` builds in full and so
+    drops.
+    """
+    if hasattr(model, 'index_documents'):
+        if fields is None:
+            return model.index_documents(ids).items()
+        return model.index_documents(ids, fields).items()
+    return [(obj.id, obj.fields())
+            for obj in model.objects.filter(id__in=ids)]
+
+
+class AdaptiveBatchSize(object):
+    """
+    Grow the batch while requests are fast, halve it when they are slow.
+
+    The size is multiplied by 1.5 whenever a request finished in under half
+    of ``target`` seconds and halved whenever one took longer than
+    ``target``.
+    """
+
+    def __init__(self, size=BULK_START_SIZE, target=BULK_TARGET_SECONDS,
+                 minimum=BULK_MIN_SIZE, maximum=BULK_MAX_SIZE):
+        self.size = size
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __int__(self):
+        return self.size
+
+    def record(self, seconds):
+        if seconds > self.target:
+            self.size = max(self.minimum, self.size // 2)
+        elif seconds < self.target / 2:
+            self.size = min(self.maximum, int(self.size * 1.5))
+        return self.size
+
+
+class IndexReport(object):
+    """Running totals for a bulk indexing run."""
+
+    def __init__(self, model):
+        self.model = model
+        self.docs = 0
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.start = time.time()
+        self.end = None
+
+    def finish(self):
+        self.end = time.time()
+        return self
+
+    @property
+    def seconds(self):
+        return (self.end or time.time()) - self.start
+
+    @property
+    def docs_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.docs / self.seconds
+
+    def __str__(self):
+        return ('Indexed %d %s documents in %d bulk requests; %.1fs total, '
+                '%.1fs in ES, %.1f docs/sec.' %
+                (self.docs, self.model._meta.object_name, self.requests,
+                 self.seconds, self.request_seconds, self.docs_per_second))
+
+
+def index_name(model):
+    """The name of the index ``model``'s documents live in."""
+    indexes = settings.ES_INDEXES
+    return indexes.get(model._meta.db_table) or indexes['default']
+
+
+def create_index(name, models, es=None):
+    """
+    Create the index ``name`` with our analyzers and ``models``' mappings.
+
+    Analyzers can't be added to an existing index, so changing them means
+    building a new index and reindexing into it.
+    """
+    es = es or get_es()
+    es.create_index_if_missing(name, INDEX_SETTINGS)
+    for model in models:
+        if hasattr(model, 'get_mapping'):
+            es.put_mapping(model._meta.db_table, model.get_mapping(), [name])
+
+
+def building_index(model):
+    """The versioned index a :func:`reindex` is filling for ``model``."""
+    return cache.get(REINDEX_KEY % index_name(model))
+
+
+def write_indexes(model):
+    """
+    Every index changes to ``model``'s documents have to be written to.
+
+    That is the live index (or alias) plus, while :func:`reindex` runs, the
+    new index being built, so it doesn't miss updates made during the build.
+    """
+    indexes = [index_name(model)]
+    building = building_index(model)
+    if building:
+        indexes.append(building)
+    return indexes
+
+
+def send_bulk(model, documents, es=None, indexes=None):
+    """
+    Send ``documents`` to ElasticSearch as one ``_bulk`` request.
+
+    They are written to every index in ``indexes``, which defaults to
+    :func:`write_indexes`.
+    """
+    es = es or get_es()
+    doc_type = model._meta.db_table
+    for index in indexes or write_indexes(model):
+        for id, document in documents:
+            es.index(document, index, doc_type, id=id, bulk=True)
+    es.flush_bulk(forced=True)
+
+
+def publish_changes(model, es=None, indexes=None):
+    """
+    Make changes written to ``model``'s documents searchable.
+
+    ``indexes`` (default :func:`write_indexes`) are refreshed before the
+    search cache generation is bumped: until ElasticSearch refreshes an
+    index, searches still find the old documents and would cache them again
+    under the new generation.
+    """
+    es = es or get_es()
+    es.refresh(indexes or write_indexes(model), timesleep=0)
+    searchcache.bump_generation(model)
+
+
+def get_sources(model, ids, es=None):
+    """
+    Return ``{id: document}`` for the documents of ``ids`` in the index.
+
+    Uses a single multi-get; ids that aren't indexed are left out.
+    """
+    es = es or get_es()
+    if not ids:
+        return {}
+    try:
+        hits = es.mget(list(ids), index_name(model), model._meta.db_table)
+    except NotFoundException:
+        return {}
+    # Our documents carry their own id.
+    return dict((hit['id'], dict(hit)) for hit in hits if hit)
+
+
+def update_fields(model, ids, fields, es=None):
+    """
+    Rewrite only ``fields`` of the indexed documents of ``ids``.
+
+    Only those fields are built from the database.  The ElasticSearch we run
+    has no ``_update`` API, so the stored documents are fetched with one
+    multi-get, the new values merged in and the result written back with
+    one ``_bulk`` request.  Documents that aren't indexed yet are built in
+    full.
+
+    While a :func:`reindex` runs, whole documents are written instead: the
+    stored ones come from the live index, and merging into those would copy
+    its old documents over the ones the new index was just given.
+    """
+    es = es or get_es()
+    if building_index(model):
+        documents = get_documents(model, ids)
+        if documents:
+            send_bulk(model, documents, es)
+        return len(documents)
+    values = dict(get_documents(model, ids, fields))
+    stored = get_sources(model, values.keys(), es)
+    documents, missing = [], []
+    for id, changed in values.iteritems():
+        if id in stored:
+            stored[id].update(changed)
+            documents.append((id, stored[id]))
+        else:
+            missing.append(id)
+    if missing:
+        documents.extend(get_documents(model, missing))
+    if documents:
+        send_bulk(model, documents, es)
+    return len(documents)
+
+
+def delete_documents(model, ids, es=None):
+    """Remove ``ids`` from every index ``model`` is written to."""
+    es = es or get_es()
+    doc_type = model._meta.db_table
+    for index in write_indexes(model):
+        for id in ids:
+            try:
+                es.delete(index, doc_type, id)
+            except NotFoundException:
+                pass
+
+
+def bulk_index(model, ids=None, batch=None, indexes=None):
+    """
+    Index ``ids`` (default: every row of ``model``) through the bulk API.
+
+    ``ids`` may be any iterable, including a :func:`stream_ids` generator.
+    ``indexes`` is passed on to :func:`send_bulk`.  Returns an
+    :class:`IndexReport`.
+    """
+    report = IndexReport(model)
+
+    if getattr(settings, 'ES_DISABLED', False):
+        # The local index rebuilds itself from the database on first use.
+        from common import search
+        search.reset_index(model)
+        return report.finish()
+
+    if ids is None:
+        ids = stream_ids(model)
+    if batch is None:
+        batch = AdaptiveBatchSize()
+
+    es = get_es()
+
+    pending = []
+    for id in ids:
+        pending.append(id)
+        if len(pending) >= int(batch):
+            _index_batch(model, pending, batch, report, es, indexes)
+            pending = []
+    if pending:
+        _index_batch(model, pending, batch, report, es, indexes)
+
+    publish_changes(model, es, indexes)
+    report.finish()
+    log.info(str(report))
+    return report
+
+
+def _index_batch(model, ids, batch, report, es, indexes):
+    documents = get_documents(model, ids)
+    if not documents:
+        return
+    # Looked up per batch so a reindex started meanwhile gets double-written.
+    targets = indexes or write_indexes(model)
+    # send_bulk queues one action per document and index; make sure pyes
+    # never flushes behind our back mid-batch.
+    es.bulk_size = (batch.maximum + 1) * len(targets)
+    start = time.time()
+    send_bulk(model, documents, es, targets)
+    elapsed = time.time() - start
+    report.docs += len(documents)
+    report.requests += 1
+    report.request_seconds += elapsed
+    batch.record(elapsed)
+    log.debug('Bulk indexed %d %s documents in %.2fs; next batch %d.' %
+              (len(documents), model._meta.object_name, elapsed, int(batch)))
+
+
+def reindex(models, keep=1):
+    """
+    Rebuild the index ``models`` share without taking search down.
+
+    The live index name from ``ES_INDEXES`` is treated as an alias.  A new
+    ``<alias>_<timestamp>`` index is created with the current analyzers and
+    mappings and filled with :func:`bulk_index`, while the signal handlers
+    double-write live changes into it (see :func:`write_indexes`).  Rows
+    that changed during the build are indexed once more, the alias is moved
+    to the new index in one atomic request and all but the ``keep`` most
+    recent older versions are deleted.
+
+    The very first run replaces a plain index that has the alias' name, so
+    search is unavailable between its deletion and the alias being added.
+    """
+    es = get_es()
+    alias = index_name(models[0])
+    new = '%s_%s' % (alias, datetime.now().strftime('%Y%m%d%H%M%S'))
+    started = datetime.now()
+
+    create_index(new, models, es)
+    cache.set(REINDEX_KEY % alias, new, REINDEX_TIMEOUT)
+    reports = []
+    try:
+        for model in models:
+            reports.append(bulk_index(model, indexes=[new]))
+        # Catch up on rows saved while their old version was being copied.
+        for model in models:
+            if 'last_updated' in [f.name for f in model._meta.fields]:
+                changed = model.objects.filter(last_updated__gte=started)
+                bulk_index(model, stream_ids(model, queryset=changed),
+                           indexes=[new])
+        es.refresh(new)
+
+        # get_indices() lists real indexes only, not aliases.
+        if alias in es.get_indices():
+            # First run: a plain index still has the alias' name.
+            es.delete_index(alias)
+            old = []
+        else:
+            try:
+                old = [i for i in es.get_alias(alias) if i != new]
+            except IndexMissingException:
+                # Fresh cluster: neither an index nor an alias yet.
+                old = []
+        es.change_aliases([('remove', i, alias) for i in old] +
+                          [('add', new, alias)])
+    finally:
+        cache.delete(REINDEX_KEY % alias)
+
+    versions = sorted(i for i in es.get_indices()
+                      if i.startswith(alias + '_') and i != new)
+    for index in versions[:max(0, len(versions) - keep)]:
+        log.info('Deleting old index %s.' % index)
+        es.delete_index(index)
+
+    for model in models:
+        searchcache.bump_generation(model)
+    log.info('Reindexed into %s and moved alias %s to it.' % (new, alias))
+    return new, reports
+
+
+class IndexCoalescer(threading.local):
+    """
+    Collects the ids of objects that need reindexing and indexes each once.
+
+    Outside of a :meth:`begin`/:meth:`end` block every :meth:`add` is flushed
+    right away.  Inside one, ids are held until the outermost block ends and
+    then sent as one ``index_objects`` task per model.  ``scheduled`` and
+    ``duplicates`` count every id handed in and every one that was dropped
+    because it was already pending.
+
+    :meth:`add_fields` holds ids of which only some fields changed in
+    ``partial``; they become one ``update_fields`` task per model and set of
+    fields, unless the whole document is being reindexed anyway.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.pending = {}
+        self.partial = {}
+        self.scheduled = 0
+        self.duplicates = 0
+
+    def begin(self):
+        self.depth += 1
+
+    def end(self):
+        self.depth = max(0, self.depth - 1)
+        if not self.depth:
+            self.flush()
+
+    def add(self, model, ids):
+        pending = self.pending.setdefault(model, set())
+        for id in ids:
+            self.scheduled += 1
+            if id in pending:
+                self.duplicates += 1
+            else:
+                pending.add(id)
+        if not self.depth:
+            self.flush()
+
+    def add_fields(self, model, ids, fields):
+        partial = self.partial.setdefault(model, {})
+        for id in ids:
+            partial.setdefault(id, set()).update(fields)
+        if not self.depth:
+            self.flush()
+
+    def discard(self, model, ids):
+        self.pending.get(model, set()).difference_update(ids)
+        partial = self.partial.get(model, {})
+        for id in ids:
+            partial.pop(id, None)
+
+    def flush(self):
+        from common import search, tasks
+
+        pending, self.pending = self.pending, {}
+        partial, self.partial = self.partial, {}
+        for model, changes in partial.iteritems():
+            by_fields = {}
+            for id, fields in changes.iteritems():
+                if id not in pending.get(model, ()):
+                    by_fields.setdefault(frozenset(fields), []).append(id)
+            for fields, ids in by_fields.iteritems():
+                ids, fields = sorted(ids), sorted(fields)
+                if getattr(settings, 'ES_DISABLED', False):
+                    search.update_fields(model, ids, fields)
+                else:
+                    tasks.update_fields.apply_async(
+                        args=[model, ids, fields],
+                        countdown=INDEX_UPDATE_COUNTDOWN)
+        for model, ids in pending.iteritems():
+            if not ids:
+                continue
+            ids = sorted(ids)
+            if getattr(settings, 'ES_DISABLED', False):
+                search.index_objects(model, ids)
+            else:
+                tasks.index_objects.apply_async(
+                    args=[model, ids], countdown=INDEX_UPDATE_COUNTDOWN)
+        if self.scheduled:
+            log.info('Index flush: %d ids scheduled, %d duplicates dropped.'
+                      % (self.scheduled, self.duplicates))
+        self.scheduled = self.duplicates = 0
+
+
+#: The coalescer for the current thread.
+coalescer = IndexCoalescer()
+
+
+def schedule_index(model, ids):
+    """Mark ``ids`` of ``model`` as needing to be reindexed."""
+    coalescer.add(model, ids)
+
+
+def schedule_fields(model, ids, fields):
+    """Mark ``fields`` of the documents of ``ids`` as out of date."""
+    coalescer.add_fields(model, ids, fields)
+
+
+def schedule_m2m_update(indexed, field, instance, action, reverse, pk_set,
+                        **kw):
+    """
+    Schedule ``field`` of the documents an ``m2m_changed`` signal touched.
+
+    Call it with the rest of the signal's arguments from a receiver
+    connected to the through model of ``indexed.field``.  It handles both
+    sides of the relation; for a reverse ``clear()`` the affected ids are
+    read before the rows go.
+    """
+    if action not in ('pre_clear', 'post_clear', 'post_add', 'post_remove'):
+        return
+    if not reverse:
+        if pk_set or action == 'post_clear':
+            schedule_fields(indexed, [instance.id], [field])
+        return
+    m2m = indexed._meta.get_field(field)
+    key = '_index_cleared_%s' % indexed._meta.db_table
+    if action == 'pre_clear':
+        rows = m2m.rel.through.objects.filter(
+            **{m2m.m2m_reverse_field_name(): instance})
+        setattr(instance, key,
+                list(rows.values_list(m2m.m2m_field_name(), flat=True)))
+    elif action == 'post_clear':
+        schedule_fields(indexed, instance.__dict__.pop(key, []), [field])
+    elif pk_set:
+        schedule_fields(indexed, pk_set, [field])
+
+
+@contextmanager
+def coalesced():
+    """Hold index updates until the end of the block and send them once."""
+    coalescer.begin()
+    try:
+        yield coalescer
+    finally:
+        coalescer.end()
+
+
+def schedule_bulk_index(model, ids):
+    """
+    Reindex a possibly large set of ``ids`` of ``model`` in the background.
+
+    Unlike :func:`schedule_index` the ids go through :func:`bulk_index`, so
+    they are sent in adaptively sized batches rather than one request.  The
+    task waits :data:`INDEX_UPDATE_COUNTDOWN` seconds like the coalescer's,
+    so the transaction that scheduled it (a merge in the admin, say) has
+    committed by the time it reads the database.
+    """
+    from common import search, tasks
+
+    ids = sorted(set(ids))
+    if not ids:
+        return
+    if getattr(settings, 'ES_DISABLED', False):
+        search.index_objects(model, ids)
+    else:
+        tasks.bulk_index_objects.apply_async(
+            args=[model, ids], countdown=INDEX_UPDATE_COUNTDOWN)
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.http import HttpResponse
+
+from tower import ugettext as _
+
+from common import indexing
+
+
+class IndexCoalescingMiddleware(object):
+    """Send the search index updates a request causes as one batch."""
+
+    def process_request(self, request):
+        indexing.coalescer.begin()
+
+    def process_response(self, request, response):
+        indexing.coalescer.end()
+        return response
+
+
+class UploadSizeMiddleware(object):
+    """
+    Refuse uploads whose body can't fit a photo before it is read.
+
+    Runs in ``process_request``, ahead of anything (such as the CSRF check)
+    that reads ``request.POST``.
+    """
+
+    def process_request(self, request):
+        if not request.META.get('CONTENT_TYPE', '').startswith('multipart/'):
+            return
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > settings.MAX_UPLOAD_REQUEST_SIZE:
+            return HttpResponse(_(u'This upload is too large.'), status=413,
+                                content_type='text/plain; charset=utf-8')
@@ -0,0 +1,133 @@
+"""
+Cursor pagination for the infinite-scrolling result lists.
+
+Django's ``Paginator`` needs a count and an offset for every page, so each
+page the infinite scroll asks for is slower than the one before.  Instead,
+every page now comes with an opaque cursor for the next one:
+
+* database lists are paged by keyset: the cursor holds the ordering values
+  of the last row shown and the next page is read with a ``WHERE (a, b) >
+  (x, y)`` style filter, which costs the same at any depth;
+* search "cursors" are only offsets into the result list.  The ElasticSearch
+  we run has no ``search_after`` (and no way to filter on ``_score``), so a
+  deep page still costs a ``from``/``size`` query, or a slice of the local
+  index, just like ``?page=N`` would.  What they save is the count request;
+  pages are cached by :mod:`common.searchcache`.  Results indexed between two
+  requests can shift the list, so a row may be shown twice or skipped.
+
+A page is fetched with one extra row to find out whether there is a next
+one, so nothing ever has to be counted.
+"""
+import base64
+import json
+
+from django.core.paginator import (EmptyPage, Page, PageNotAnInteger,
+                                   Paginator)
+from django.db.models import Q
+
+
+class SearchPaginator(Paginator):
+    """
+    A ``Paginator`` for search results that doesn't count them separately.
+
+    ``Paginator`` asks for the total before it fetches a page, which costs a
+    search request of its own.  Here the page is fetched first and the total
+    taken from the same response (see :func:`common.search.fetch_page`).
+    """
+
+    def page(self, number):
+        from common.search import fetch_page
+
+        if self._count is not None:
+            return super(SearchPaginator, self).page(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        bottom = (number - 1) * self.per_page
+        results, self._count = fetch_page(self.object_list, bottom,
+                                          bottom + self.per_page)
+        if number > self.num_pages:
+            raise EmptyPage('That page contains no results')
+        return Page(results, number, self)
+
+
+class CursorPage(list):
+    """A page of results; ``next_cursor`` is None on the last page."""
+
+    def __init__(self, items, next_cursor=None):
+        super(CursorPage, self).__init__(items)
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor):
+    """Return the values in ``cursor``, or None if it isn't a valid one."""
+    if not cursor:
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+
+
+def keyset_cursor(obj, fields):
+    """The cursor for the page following ``obj``."""
+    return encode_cursor([getattr(obj, f) for f in fields])
+
+
+def keyset_page(queryset, fields, cursor, limit):
+    """
+    Return the ``limit`` rows of ``queryset`` that follow ``cursor``.
+
+    Rows are ordered by ``fields`` (ascending); the last of them has to be
+    unique, e.g. ``('display_name', 'id')``.
+    """
+    queryset = queryset.order_by(*fields)
+    after = decode_cursor(cursor)
+    if after and len(after) == len(fields):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y)
+        q = Q()
+        for i, field in enumerate(fields):
+            clause = Q(**{'%s__gt' % field: after[i]})
+            for prev, value in zip(fields[:i], after[:i]):
+                clause &= Q(**{prev: value})
+            q |= clause
+        queryset = queryset.filter(q)
+
+    items = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = keyset_cursor(items[-1], fields)
+    return CursorPage(items, next_cursor)
+
+
+def offset_cursor(offset):
+    """
+    Return the cursor for the search results from ``offset`` on.
+
+    This is a position, not a keyset: see the module docstring.
+    """
+    return encode_cursor({'offset': offset})
+
+
+def search_page(results, cursor, limit):
+    """Return the ``limit`` search results that follow ``cursor``."""
+    after = decode_cursor(cursor)
+    try:
+        offset = max(0, int(after['offset']))
+    except (KeyError, TypeError, ValueError):
+        offset = 0
+
+    items = list(results[offset:offset + limit + 1])
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = offset_cursor(offset + limit)
+    return CursorPage(items, next_cursor)
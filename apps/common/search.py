@@ -0,0 +1,407 @@
+"""
+In-process stand-in for ElasticSearch.
+
+When ``settings.ES_DISABLED`` is on there is no cluster to ask, so models
+that know how to build their index documents (``fields()``) can be searched
+with an inverted index that lives in the current process instead.  The
+:class:`LocalS` object answers the subset of the elasticutils ``S`` API we
+actually use (``query(or_=...)``, ``filter()``, ``count()`` and slicing), so
+it can be handed to views and Django's ``Paginator`` unchanged.
+
+Every process builds its own index lazily from the database on first use and
+then keeps it current from the model's index/unindex signal handlers.
+"""
+import re
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from django.conf import settings
+
+from elasticutils import S
+
+from common import indexing
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+BUILD_CHUNK_SIZE = 500
+
+_indexes = {}
+_lock = threading.RLock()
+
+
+def tokenize(value):
+    """Split ``value`` into the lowercased terms it is indexed under."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [t for v in value for t in tokenize(v)]
+    if isinstance(value, bool):
+        return [u'true' if value else u'false']
+    if isinstance(value, (int, long)):
+        return [unicode(value)]
+    if isinstance(value, basestring):
+        return TOKEN_RE.findall(value.lower())
+    # Dates and anything else we can't search on aren't indexed.
+    return []
+
+
+def edge_ngrams(value, max_gram=20):
+    """Every prefix of every term, like our ``edge_ngram`` analyzer."""
+    return [t[:i] for t in tokenize(value)
+            for i in xrange(1, min(len(t), max_gram) + 1)]
+
+
+def analyzers(model):
+    """Local tokenizers for the edge-ngram fields in ``model``'s mapping."""
+    mapping = getattr(model, 'get_mapping', lambda: {})()
+    return dict((field, edge_ngrams)
+                for field, spec in mapping.get('properties', {}).iteritems()
+                if spec.get('index_analyzer') == 'edge_ngram')
+
+
+class InvertedIndex(object):
+    """
+    Maps ``(field, term)`` to a sorted posting list of document ids.
+
+    Posting lists are unsigned int arrays, so a directory of a few hundred
+    thousand profiles costs a handful of megabytes.  ``analyzers`` maps field
+    names to the function their values are split into terms with; the rest
+    use :func:`tokenize`.
+    """
+
+    def __init__(self, analyzers=None):
+        self.analyzers = analyzers or {}
+        self._postings = defaultdict(dict)
+        self._sorted_terms = {}
+        self._doc_terms = {}
+        self._documents = {}
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    def __contains__(self, id):
+        return id in self._doc_terms
+
+    def ids(self):
+        return self._doc_terms.keys()
+
+    def add(self, id, document):
+        """Index (or re-index) ``document`` under ``id``."""
+        self.remove(id)
+        doc_terms = []
+        for field, value in document.iteritems():
+            if field != 'id':
+                doc_terms.extend(self._add_terms(id, field, value))
+        self._doc_terms[id] = doc_terms
+        self._documents[id] = document
+
+    def update(self, id, fields):
+        """
+        Replace only ``fields`` (a dict) of the document indexed as ``id``.
+
+        The posting lists of the document's other fields are left alone.
+        """
+        doc_terms = []
+        for field, term in self._doc_terms[id]:
+            if field in fields:
+                self._remove_term(id, field, term)
+            else:
+                doc_terms.append((field, term))
+        for field, value in fields.iteritems():
+            doc_terms.extend(self._add_terms(id, field, value))
+        self._doc_terms[id] = doc_terms
+        self._documents[id] = dict(self._documents[id], **fields)
+
+    def _add_terms(self, id, field, value):
+        postings = self._postings[field]
+        analyze = self.analyzers.get(field, tokenize)
+        terms = set(analyze(value))
+        for term in terms:
+            posting = postings.get(term)
+            if posting is None:
+                posting = postings[term] = array('I')
+                self._sorted_terms.pop(field, None)
+            insort(posting, id)
+        return [(field, term) for term in terms]
+
+    def _remove_term(self, id, field, term):
+        postings = self._postings[field]
+        posting = postings[term]
+        posting.pop(bisect_left(posting, id))
+        if not posting:
+            del postings[term]
+            self._sorted_terms.pop(field, None)
+
+    def add_documents(self, documents):
+        for id, document in documents:
+            self.add(id, document)
+
+    def remove(self, id):
+        """Drop ``id`` from every posting list it appears in."""
+        self._documents.pop(id, None)
+        for field, term in self._doc_terms.pop(id, ()):
+            self._remove_term(id, field, term)
+
+    def document(self, id):
+        return self._documents[id]
+
+    def _terms(self, field):
+        terms = self._sorted_terms.get(field)
+        if terms is None:
+            terms = self._sorted_terms[field] = sorted(self._postings[field])
+        return terms
+
+    def term(self, field, value):
+        """Ids whose ``field`` holds ``value`` as one whole term."""
+        terms = tokenize(value)
+        if len(terms) != 1:
+            return set()
+        return set(self._postings[field].get(terms[0], ()))
+
+    def text(self, field, value):
+        """Ids whose ``field`` contains any term of ``value``."""
+        postings = self._postings[field]
+        ids = set()
+        for t in tokenize(value):
+            ids.update(postings.get(t, ()))
+        return ids
+
+    def prefix(self, field, value):
+        """Ids whose ``field`` has a term starting with ``value``."""
+        prefix = value.lower()
+        if not prefix:
+            return set()
+        postings = self._postings[field]
+        terms = self._terms(field)
+        ids = set()
+        for i in xrange(bisect_left(terms, prefix), len(terms)):
+            if not terms[i].startswith(prefix):
+                break
+            ids.update(postings[terms[i]])
+        return ids
+
+    def match(self, key, value):
+        """Evaluate a single elasticutils-style ``field__action`` clause."""
+        field, _, action = key.partition('__')
+        if action == 'text':
+            return self.text(field, value)
+        if action == 'startswith':
+            return self.prefix(field, value)
+        if not action:
+            return self.term(field, value)
+        raise ValueError('Unsupported search action: %s' % key)
+
+
+class LocalS(object):
+    """An elasticutils ``S`` look-alike backed by an :class:`InvertedIndex`."""
+
+    def __init__(self, model):
+        self.model = model
+        self.queries = []
+        self.filters = []
+        self.as_dicts = False
+        self._ids = None
+
+    def _clone(self):
+        s = self.__class__(self.model)
+        s.queries = list(self.queries)
+        s.filters = list(self.filters)
+        s.as_dicts = self.as_dicts
+        return s
+
+    def query(self, **kw):
+        """Every keyword must match; at least one clause of ``or_`` must."""
+        s = self._clone()
+        or_ = kw.pop('or_', None)
+        if or_:
+            s.queries.append(or_)
+        for key, value in kw.iteritems():
+            s.queries.append({key: value})
+        return s
+
+    def filter(self, **kw):
+        s = self._clone()
+        s.filters.extend(kw.iteritems())
+        return s
+
+    def values_dict(self):
+        """Return the indexed documents rather than model instances."""
+        s = self._clone()
+        s.as_dicts = True
+        return s
+
+    def _result_ids(self):
+        """Matching ids, most matched clauses first and ties broken by id."""
+        if self._ids is not None:
+            return self._ids
+
+        index = get_index(self.model)
+        with _lock:
+            scores = None
+            for clauses in self.queries:
+                hits = defaultdict(int)
+                for key, value in clauses.iteritems():
+                    for id in index.match(key, value):
+                        hits[id] += 1
+                if scores is not None:
+                    hits = dict((i, scores[i] + n)
+                                for i, n in hits.iteritems() if i in scores)
+                scores = hits
+
+            if scores is None:
+                scores = dict.fromkeys(index.ids(), 0)
+
+            for key, value in self.filters:
+                allowed = index.term(key, value)
+                scores = dict((i, n) for i, n in scores.iteritems()
+                              if i in allowed)
+
+        self._ids = sorted(scores, key=lambda i: (-scores[i], i))
+        return self._ids
+
+    def _hydrate(self, ids):
+        if self.as_dicts:
+            index = get_index(self.model)
+            with _lock:
+                return [dict(index.document(i)) for i in ids]
+        objs = self.model.objects.in_bulk(ids)
+        return [objs[i] for i in ids if i in objs]
+
+    def count(self):
+        return len(self._result_ids())
+
+    def page(self, start, stop):
+        ids = self._result_ids()
+        return self._hydrate(ids[start:stop]), len(ids)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self._hydrate(self._result_ids()))
+
+    def __getitem__(self, k):
+        ids = self._result_ids()
+        if isinstance(k, slice):
+            return self._hydrate(ids[k])
+        return self._hydrate([ids[k]])[0]
+
+
+class HitList(object):
+    """
+    Wraps a ``values_dict()`` search so each result is built by ``factory``.
+
+    Supports ``count()`` and slicing, so it can be paginated like the search
+    it wraps.
+    """
+
+    def __init__(self, search, factory):
+        self.search = search
+        self.factory = factory
+
+    def count(self):
+        return self.search.count()
+
+    def page(self, start, stop):
+        results, total = fetch_page(self.search, start, stop)
+        return [self.factory(d) for d in results], total
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return (self.factory(d) for d in self.search)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self.factory(d) for d in self.search[k]]
+        return self.factory(self.search[k])
+
+
+def fetch_page(s, start, stop):
+    """
+    Return ``(results, total)`` for ``s[start:stop]`` with one search.
+
+    Searches that can do so provide ``page(start, stop)``.  An elasticutils
+    ``S`` keeps the response of a search it has run and answers ``count()``
+    from that response's total.
+    """
+    if hasattr(s, 'page'):
+        return s.page(start, stop)
+    s = s[start:stop]
+    results = list(s)
+    return results, s.count()
+
+
+def get_search(model):
+    """Return the search object ``model`` should be queried with."""
+    if getattr(settings, 'ES_DISABLED', False):
+        return LocalS(model)
+    return S(model)
+
+
+def get_index(model):
+    """Return the in-process index for ``model``, building it if needed."""
+    with _lock:
+        index = _indexes.get(model)
+        if index is None:
+            index = InvertedIndex(analyzers(model))
+            chunk = []
+            for id in indexing.stream_ids(model, BUILD_CHUNK_SIZE):
+                chunk.append(id)
+                if len(chunk) == BUILD_CHUNK_SIZE:
+                    index.add_documents(indexing.get_documents(model, chunk))
+                    chunk = []
+            index.add_documents(indexing.get_documents(model, chunk))
+            _indexes[model] = index
+        return index
+
+
+def reset_index(model=None):
+    """Throw away the in-process index for ``model`` (or for every model)."""
+    with _lock:
+        if model is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(model, None)
+
+
+def index_objects(model, ids):
+    """Refresh ``ids`` in the local index, if one has been built."""
+    with _lock:
+        index = _indexes.get(model)
+        if index is None:
+            return
+        documents = dict(indexing.get_documents(model, ids))
+        for id in ids:
+            if id in documents:
+                index.add(id, documents[id])
+            else:
+                index.remove(id)
+
+
+def update_fields(model, ids, fields):
+    """Rebuild only ``fields`` of ``ids`` in the local index, if built."""
+    with _lock:
+        index = _indexes.get(model)
+        if index is None:
+            return
+        missing = []
+        for id, values in indexing.get_documents(model, ids, fields):
+            if id in index:
+                index.update(id, values)
+            else:
+                missing.append(id)
+        if missing:
+            index.add_documents(indexing.get_documents(model, missing))
+
+
+def unindex_objects(model, ids):
+    """Remove ``ids`` from the local index, if one has been built."""
+    with _lock:
+        index = _indexes.get(model)
+        if index is None:
+            return
+        for id in ids:
+            index.remove(id)
@@ -0,0 +1,100 @@
+"""
+Short-lived cache of search result pages.
+
+People type the same few names into the search box over and over, and the
+AJAX infinite scroll asks for the same pages again.  :class:`CachedSearch`
+sits in front of a ``values_dict()`` search and keeps its total count and
+each requested slice in the cache for :data:`SEARCH_CACHE_TIMEOUT` seconds.
+
+Keys include a per-model generation number, which :func:`bump_generation`
+increments whenever documents of that model are (re)indexed, so a changed
+profile never outlives its old results by more than the indexing delay.
+"""
+import hashlib
+
+from django.core.cache import cache
+
+from common import generations
+
+SEARCH_CACHE_TIMEOUT = 60
+
+GENERATION_KEY = 'search:generation:%s'
+STATS_KEY = 'search:cache:%s'
+
+
+def _model_key(model):
+    return model._meta.db_table
+
+
+def generation(model):
+    return generations.get(GENERATION_KEY % _model_key(model))
+
+
+def bump_generation(model):
+    """Invalidate every cached search result for ``model``."""
+    generations.bump(GENERATION_KEY % _model_key(model))
+
+
+def _count(stat):
+    key = STATS_KEY % stat
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, generations.GENERATION_TIMEOUT)
+
+
+def stats():
+    """Return the cache hit and miss counts, summed over all processes."""
+    return dict((stat, cache.get(STATS_KEY % stat) or 0)
+                for stat in ('hits', 'misses'))
+
+
+class CachedSearch(object):
+    """
+    Caches ``count()`` and slices of ``search`` under ``params``.
+
+    ``params`` should identify the query completely (normalized query
+    string, filters); the slice bounds stand for page and limit.
+    """
+
+    def __init__(self, search, model, params):
+        self.search = search
+        key = hashlib.md5(repr(params)).hexdigest()
+        self.prefix = 'search:%s:%s:%s' % (_model_key(model),
+                                           generation(model), key)
+
+    def _get(self, suffix, compute):
+        key = '%s:%s' % (self.prefix, suffix)
+        value = cache.get(key)
+        if value is None:
+            _count('misses')
+            value = compute()
+            cache.set(key, value, SEARCH_CACHE_TIMEOUT)
+        else:
+            _count('hits')
+        return value
+
+    def count(self):
+        return self._get('count', self.search.count)
+
+    def page(self, start, stop):
+        """Cache a page and the total count fetched with it."""
+        from common.search import fetch_page
+
+        def compute():
+            results, total = fetch_page(self.search, start, stop)
+            cache.set('%s:count' % self.prefix, total, SEARCH_CACHE_TIMEOUT)
+            return list(results), total
+        return self._get('page:%s-%s' % (start, stop), compute)
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return iter(self.search)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self._get('%s-%s' % (k.start, k.stop),
+                             lambda: list(self.search[k]))
+        return self.search[k]
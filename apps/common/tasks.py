@@ -0,0 +1,54 @@
+from django.conf import settings
+
+import commonware.log
+from celery.task import task
+
+from common import indexing
+
+log = commonware.log.getLogger('m.tasks')
+
+
+@task
+def index_objects(model, ids, **kw):
+    """Index ``ids`` of ``model`` with a single _bulk request."""
+    if getattr(settings, 'ES_DISABLED', False):
+        return
+    log.info('Indexing %s %s-%s. [%s]' % (model._meta.object_name,
+                                          ids[0], ids[-1], len(ids)))
+    indexing.send_bulk(model, indexing.get_documents(model, ids))
+    indexing.publish_changes(model)
+
+
+@task
+def bulk_index_objects(model, ids, **kw):
+    """Index ``ids`` of ``model`` in batches through the _bulk API."""
+    if getattr(settings, 'ES_DISABLED', False):
+        return
+    indexing.bulk_index(model, ids)
+
+
+@task
+def unindex_objects(model, ids, **kw):
+    """Remove ``ids`` of ``model`` from every index it is written to."""
+    if getattr(settings, 'ES_DISABLED', False):
+        return
+    indexing.delete_documents(model, ids)
+    indexing.publish_changes(model)
+
+
+@task
+def update_fields(model, ids, fields, **kw):
+    """Rewrite only ``fields`` of the indexed documents of ``ids``."""
+    if getattr(settings, 'ES_DISABLED', False):
+        return
+    indexing.update_fields(model, ids, fields)
+    indexing.publish_changes(model)
+
+
+@task
+def generate_thumbnails(storage, names, only=None, **kw):
+    """Generate the registered thumbnails of ``names`` in ``storage``."""
+    from common import thumbnails
+
+    thumbnails.generate_all([thumbnails.StoredFile(storage, name)
+                             for name in names], only)
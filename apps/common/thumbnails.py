@@ -0,0 +1,160 @@
+"""
+Pre-generated thumbnails for the ``thumbnail`` template helper.
+
+``sorl.thumbnail.get_thumbnail`` looks every thumbnail up in sorl's key-value
+store and generates missing ones while the page waits.  Instead, the sizes
+templates ask for are listed in ``settings.THUMBNAIL_SIZES`` and generated
+ahead of time: when a photo is processed (see ``users.tasks``) and by the
+``regenerate_thumbnails`` cron job.  Their URLs are kept in memcached and in
+a dict in each process, so a template lookup is a dict access.
+
+A lookup that misses queues the thumbnail for generation and returns the
+URL of the original image, which the browser scales in the meantime.
+Stored photos are named after their content, so a URL never goes stale.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+
+import commonware.log
+from PIL import Image
+from sorl.thumbnail import get_thumbnail
+
+log = commonware.log.getLogger('m.thumbnails')
+
+KEY = 'thumbnail:%s'
+CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+#: How long a missing thumbnail isn't queued again.
+PENDING_TIMEOUT = 60
+
+#: Entries kept per process before the dict is emptied.
+LOCAL_MAX = 10000
+
+_urls = {}
+
+
+class StoredFile(object):
+    """The file ``name`` in ``storage``, as sorl expects a source to be."""
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+
+class Thumbnail(object):
+    """What the ``thumbnail`` helper returns; templates use ``url``."""
+
+    def __init__(self, url):
+        self.url = url
+
+    def __unicode__(self):
+        return self.url
+
+
+def sizes():
+    """The ``(geometry, options)`` of every registered size."""
+    return [(size, {}) if isinstance(size, basestring) else size
+            for size in settings.THUMBNAIL_SIZES]
+
+
+def source_file(source):
+    """Turn a field file or a name in the default storage into a source."""
+    if isinstance(source, basestring):
+        return StoredFile(default_storage, source)
+    return StoredFile(source.storage, source.name)
+
+
+def _key(source, geometry, options):
+    key = repr((source.name, geometry, sorted(options.items())))
+    return KEY % hashlib.md5(key).hexdigest()
+
+
+def _remember(key, url):
+    if len(_urls) >= LOCAL_MAX:
+        _urls.clear()
+    _urls[key] = url
+
+
+def lookup(source, geometry, **options):
+    """The URL of a generated thumbnail of ``source``, or None."""
+    key = _key(source, geometry, options)
+    url = _urls.get(key)
+    if url is None:
+        url = cache.get(key)
+        if url is not None:
+            _remember(key, url)
+    return url
+
+
+def generate(source, geometry, **options):
+    """Generate (if sorl hasn't) and store one thumbnail; returns its URL."""
+    url = get_thumbnail(source, geometry, **options).url
+    key = _key(source, geometry, options)
+    cache.set(key, url, CACHE_TIMEOUT)
+    _remember(key, url)
+    return url
+
+
+def check_pixels(source):
+    """
+    Raise IOError if ``source`` has more than ``MAX_PHOTO_PIXELS`` pixels.
+
+    Only the image header is read, as ``users.tasks.make_renditions`` does.
+    """
+    f = source.storage.open(source.name)
+    try:
+        width, height = Image.open(f).size
+    finally:
+        f.close()
+    if width * height > settings.MAX_PHOTO_PIXELS:
+        raise IOError('%dx%d pixels is too many' % (width, height))
+
+
+def generate_all(sources, only=None):
+    """
+    Generate every registered size (or those in ``only``) of ``sources``.
+
+    Images with too many pixels (see :func:`check_pixels`) are skipped.
+    """
+    for source in sources:
+        try:
+            check_pixels(source)
+        except Exception as e:
+            log.error('Not making thumbnails of %s: %s' % (source.name, e))
+            continue
+        for geometry, options in only or sizes():
+            try:
+                generate(source, geometry, **options)
+            except Exception as e:
+                # sorl passes on whatever PIL or the storage raise.
+                log.error('Could not make the %s thumbnail of %s: %s' %
+                          (geometry, source.name, e))
+
+
+def get(source, geometry, **options):
+    """
+    Return the :class:`Thumbnail` of ``source`` without generating it.
+
+    On a miss the thumbnail is queued for generation (once a minute at
+    most) and the original is returned, even if queuing fails.
+    """
+    from common import tasks
+
+    source = source_file(source)
+    url = lookup(source, geometry, **options)
+    if url is None:
+        key = _key(source, geometry, options)
+        if cache.add(key + ':pending', 1, PENDING_TIMEOUT):
+            try:
+                tasks.generate_thumbnails.delay(source.storage, [source.name],
+                                                [(geometry, options)])
+            except Exception as e:
+                # The page still renders if the broker is down; the pending
+                # key makes us try again in a minute, not on every render.
+                log.error('Could not queue the %s thumbnail of %s: %s' %
+                          (geometry, source.name, e))
+        url = source.storage.url(source.name)
+    return Thumbnail(url)
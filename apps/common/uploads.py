@@ -0,0 +1,117 @@
+"""
+Bounded handling of uploaded photos.
+
+Django's default handlers keep small uploads in memory and copy big ones to
+disk without any limit, and ``forms.ImageField`` then decodes the whole
+image to validate it.  Here every upload is streamed straight to a temporary
+file and only ``settings.MAX_PHOTO_UPLOAD_SIZE`` bytes of it are kept; the
+form reads nothing but the image header to check its dimensions against
+``settings.MAX_PHOTO_PIXELS``.  Requests that are too large to hold a photo
+are refused before their body is read by
+:class:`common.middleware.UploadSizeMiddleware`.
+"""
+import struct
+
+from django.conf import settings
+from django.core.files.uploadedfile import (TemporaryUploadedFile,
+                                            UploadedFile)
+from django.core.files.uploadhandler import FileUploadHandler
+
+# JPEG start-of-frame markers (all but DHT, JPG and DAC in 0xC0-0xCF).
+_JPEG_SOF = frozenset(range(0xC0, 0xD0)) - frozenset([0xC4, 0xC8, 0xCC])
+# JPEG markers that have no length field.
+_JPEG_STANDALONE = frozenset([0x01, 0xD8] + range(0xD0, 0xD8))
+
+
+def _jpeg_dimensions(f):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != '\xff':
+            return None
+        code = ord(marker[1])
+        while code == 0xFF:
+            byte = f.read(1)
+            if not byte:
+                return None
+            code = ord(byte)
+        if code in _JPEG_STANDALONE:
+            continue
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if code in _JPEG_SOF:
+            frame = f.read(5)
+            if len(frame) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame[1:])
+            return width, height
+        f.seek(length - 2, 1)
+
+
+def image_dimensions(f):
+    """
+    Return ``(width, height)`` of a JPEG, PNG or GIF file, or None.
+
+    Only the header is read; nothing is decoded.
+    """
+    f.seek(0)
+    head = f.read(24)
+    try:
+        # Truncated headers have the magic but not the dimensions.
+        if (head[:8] == '\x89PNG\r\n\x1a\n' and head[12:16] == 'IHDR' and
+                len(head) >= 24):
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in ('GIF87a', 'GIF89a') and len(head) >= 10:
+            return struct.unpack('<HH', head[6:10])
+        if head[:2] == '\xff\xd8':
+            return _jpeg_dimensions(f)
+    finally:
+        f.seek(0)
+    return None
+
+
+class RejectedUpload(UploadedFile):
+    """Stands in for an upload that was larger than we keep."""
+
+    def __init__(self, name, content_type, size, charset=None):
+        super(RejectedUpload, self).__init__(None, name, content_type, size,
+                                             charset)
+
+
+class BoundedUploadHandler(FileUploadHandler):
+    """
+    Stream uploads to a temporary file, up to ``MAX_PHOTO_UPLOAD_SIZE``.
+
+    Once a file grows past the limit its temporary file is deleted and the
+    rest of it is dropped as it arrives; the form gets a
+    :class:`RejectedUpload` of the full size so it can say what was wrong.
+    """
+
+    def __init__(self, request=None):
+        super(BoundedUploadHandler, self).__init__(request)
+        self.max_size = settings.MAX_PHOTO_UPLOAD_SIZE
+
+    def new_file(self, *args, **kwargs):
+        super(BoundedUploadHandler, self).new_file(*args, **kwargs)
+        self.file = TemporaryUploadedFile(self.file_name, self.content_type,
+                                          0, self.charset)
+        self.rejected = False
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.rejected:
+            return
+        if start + len(raw_data) > self.max_size:
+            self.rejected = True
+            self.file.close()
+            return
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        if self.rejected:
+            return RejectedUpload(self.file_name, self.content_type,
+                                  file_size, self.charset)
+        self.file.seek(0)
+        self.file.size = file_size
+        return self.file
@@ -1,6 +1,30 @@
 from django.contrib import admin
+from django.db import transaction
 
 from .models import Group
 
 
-admin.site.register(Group)
+@transaction.commit_on_success
+def merge_groups(modeladmin, request, queryset):
+    """Merge the selected groups into the one with the most members."""
+    if queryset.filter(system=True).exists():
+        modeladmin.message_user(request, 'System groups can not be merged.')
+        return
+    groups = list(queryset.order_by('-member_count', 'id'))
+    if len(groups) < 2:
+        modeladmin.message_user(request, 'Select at least two groups.')
+        return
+    target, others = groups[0], groups[1:]
+    Group.merge(target, others)
+    modeladmin.message_user(request, 'Merged %s into %s.' % (
+        ', '.join(g.name for g in others), target.name))
+merge_groups.short_description = "Merge selected groups"
+
+
+class GroupAdmin(admin.ModelAdmin):
+    actions = (merge_groups,)
+    list_display = ('name', 'member_count', 'auto_complete', 'system')
+    search_fields = ('name',)
+
+
+admin.site.register(Group, GroupAdmin)
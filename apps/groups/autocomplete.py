@@ -0,0 +1,89 @@
+"""
+In-process prefix index for group and skill autocomplete.
+
+Every keystroke in the groups and skills fields of the profile form asks
+``/groups/search`` or ``/skills/search`` for names starting with what has
+been typed so far, which used to be an ``istartswith`` query each time.  The
+names that can be autocompleted are few and change rarely, so each process
+keeps them in a sorted array and answers prefixes with a binary search.
+
+The arrays are rebuilt (one query) when they are first used and whenever the
+per-model generation in the cache has moved on; saving or deleting a group or
+skill and the cron jobs in :mod:`groups.cron` bump it through
+:func:`invalidate`.  Matches are ranked by ``member_count``.
+"""
+import threading
+from bisect import bisect_left
+
+from common import generations
+
+GENERATION_KEY = 'autocomplete:generation:%s'
+
+_indexes = {}
+_lock = threading.RLock()
+
+
+class PrefixIndex(object):
+    """Names kept sorted for prefix lookups, each with a rank."""
+
+    def __init__(self, entries):
+        self.ranks = dict((name.lower(), rank) for name, rank in entries)
+        self.names = sorted(self.ranks)
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, prefix, limit=None):
+        """
+        Return the names starting with ``prefix``, highest rank first.
+
+        Names with the same rank are in alphabetical order.
+        """
+        prefix = prefix.lower()
+        matches = []
+        for i in xrange(bisect_left(self.names, prefix), len(self.names)):
+            if not self.names[i].startswith(prefix):
+                break
+            matches.append(self.names[i])
+        matches.sort(key=lambda name: (-self.ranks[name], name))
+        if limit is not None:
+            matches = matches[:limit]
+        return matches
+
+
+def _key(model):
+    return GENERATION_KEY % model._meta.db_table
+
+
+def generation(model):
+    return generations.get(_key(model))
+
+
+def build(model):
+    """Build the index of ``model``'s autocompleted names."""
+    rows = (model.objects.filter(auto_complete=True)
+                         .values_list('name', 'member_count'))
+    return PrefixIndex(rows)
+
+
+def get_index(model):
+    """Return this process' index for ``model``, rebuilding it if stale."""
+    gen = generation(model)
+    with _lock:
+        entry = _indexes.get(model)
+        if entry is None or entry[0] != gen:
+            entry = _indexes[model] = (gen, build(model))
+        return entry[1]
+
+
+def invalidate(model):
+    """Make every process rebuild its index for ``model``."""
+    generations.bump(_key(model))
+    with _lock:
+        _indexes.pop(model, None)
+
+
+def search(model, query, limit=None):
+    if not query:
+        return []
+    return get_index(model).search(query, limit)
@@ -1,34 +1,138 @@
+import time
+from collections import defaultdict
+
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connection, transaction
 from django.db.models import Count
 
 import commonware.log
 import cronjobs
 
-from groups.models import AUTO_COMPLETE_COUNT, Group, Skill
+from groups import autocomplete
+from groups.models import AUTO_COMPLETE_COUNT, Group, GroupSkillCount, Skill
+from users.models import UserProfile
 
 
 log = commonware.log.getLogger('m.cron')
 
 
+def _assign_autocomplete(queryset):
+    """
+    Set ``auto_complete`` on the rows of ``queryset`` from their member count.
+
+    At most two ``UPDATE``s flip the rows whose state changed.  Returns
+    ``(promoted, demoted)`` row counts.
+    """
+    promoted = (queryset.filter(member_count__gt=AUTO_COMPLETE_COUNT,
+                                auto_complete=False)
+                        .update(auto_complete=True))
+    demoted = (queryset.filter(member_count__lte=AUTO_COMPLETE_COUNT,
+                               auto_complete=True)
+                       .update(auto_complete=False))
+    return promoted, demoted
+
+
+def _reconcile_member_counts(model):
+    """Fix the ``member_count`` of ``model`` rows; returns how many."""
+    counts = dict(model.objects.annotate(count=Count('userprofile'))
+                               .values_list('id', 'count'))
+    stale = defaultdict(list)
+    for id, member_count in model.objects.values_list('id', 'member_count'):
+        count = counts.get(id, 0)
+        if count != member_count:
+            stale[count].append(id)
+    for count, ids in stale.iteritems():
+        model.objects.filter(id__in=ids).update(member_count=count)
+    return sum(len(ids) for ids in stale.itervalues())
+
+
 @cronjobs.register
 def assign_autocomplete_to_groups():
     """
     Hourly job to assign autocomplete status to Mozillian popular groups and
     skills.
     """
+    start = time.time()
     # Only assign status to non-system groups.
-    # TODO: add stats.d timer here
-    for g in (Group.objects.filter(always_auto_complete=False, system=False)
-                           .annotate(count=Count('userprofile'))):
-        g.auto_complete = g.count > AUTO_COMPLETE_COUNT
-        g.save()
+    groups = _assign_autocomplete(
+        Group.objects.filter(always_auto_complete=False, system=False))
 
     # Assign appropriate status to skills
-    for g in (Skill.objects.filter(always_auto_complete=False)
-                           .annotate(count=Count('userprofile'))):
-        g.auto_complete = g.count > AUTO_COMPLETE_COUNT
-        g.save()
+    skills = _assign_autocomplete(
+        Skill.objects.filter(always_auto_complete=False))
+
+    # update() sends no signals and member counts have moved on too, so
+    # re-rank the autocomplete lists.
+    autocomplete.invalidate(Group)
+    autocomplete.invalidate(Skill)
+
+    report = ('Autocomplete: %d groups and %d skills added, %d groups and %d '
+              'skills removed in %.2fs.' % (groups[0], skills[0], groups[1],
+                                            skills[1], time.time() - start))
+    log.info(report)
+    return report
+
+
+@cronjobs.register
+def reconcile_member_counts():
+    """
+    Daily job to recount the members of every group and skill, in case the
+    counts the m2m_changed handler keeps have drifted.
+    """
+    start = time.time()
+    groups = _reconcile_member_counts(Group)
+    skills = _reconcile_member_counts(Skill)
+    autocomplete.invalidate(Group)
+    autocomplete.invalidate(Skill)
+
+    report = ('Member counts: fixed %d groups and %d skills in %.2fs.' %
+              (groups, skills, time.time() - start))
+    log.info(report)
+    return report
+
+
+@cronjobs.register
+@transaction.commit_on_success
+def rebuild_group_skill_counts():
+    """
+    Hourly job to recount how many members of each group have each skill.
+
+    The whole table is replaced in one transaction by a single
+    ``INSERT ... SELECT`` over the two membership tables.
+    """
+    start = time.time()
+    qn = connection.ops.quote_name
+    sql = dict(table=qn(GroupSkillCount._meta.db_table),
+               groups=qn(UserProfile.groups.through._meta.db_table),
+               skills=qn(UserProfile.skills.through._meta.db_table),
+               count=qn('count'))
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %(table)s' % sql)
+    cursor.execute('INSERT INTO %(table)s (group_id, skill_id, %(count)s) '
+                   'SELECT g.group_id, s.skill_id, COUNT(*) '
+                   'FROM %(groups)s g INNER JOIN %(skills)s s '
+                   'ON s.userprofile_id = g.userprofile_id '
+                   'GROUP BY g.group_id, s.skill_id' % sql)
+
+    report = ('Group skills: counted %d group/skill pairs in %.2fs.' %
+              (cursor.rowcount, time.time() - start))
+    log.info(report)
+    return report
+
+
+@cronjobs.register
+def rebuild_related_groups():
+    """Nightly job to recompute the related groups and skills of groups."""
+    # Imported here so the other jobs don't need NumPy and SciPy.
+    from groups import similarity
+
+    start = time.time()
+    count = similarity.rebuild()
+    report = ('Related groups: stored neighbours of %d groups in %.2fs.' %
+              (count, time.time() - start))
+    log.info(report)
+    return report
 
 
 @cronjobs.register
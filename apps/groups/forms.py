@@ -11,10 +11,29 @@ from .models import Group
 class GroupWidget(forms.TextInput):
     def render(self, name, value, attrs=None):
         if not (value is None or isinstance(value, basestring)):
-            value = stringify_groups(Group.objects.get(pk=v) for v in value)
+            value = stringify_groups(self.resolve(value))
 
         return super(GroupWidget, self).render(name, value, attrs)
 
+    @staticmethod
+    def resolve(values):
+        """
+        Turn the primary keys among ``values`` into Groups, keeping order.
+
+        All keys are looked up with one query; Groups and names are passed
+        through and unknown keys dropped.
+        """
+        values = list(values)
+        pks = [v for v in values if not isinstance(v, (Group, basestring))]
+        groups = Group.objects.in_bulk(pks) if pks else {}
+        resolved = []
+        for v in values:
+            if isinstance(v, (Group, basestring)):
+                resolved.append(v)
+            elif v in groups:
+                resolved.append(groups[v])
+        return resolved
+
 
 class GroupField(forms.CharField):
     widget = GroupWidget
@@ -31,11 +50,4 @@ class GroupField(forms.CharField):
         values = [g.strip() for g in value.lower().split(',')
                   if g and ',' not in g]
 
-        groups = []
-        for g in values:
-            (group, created) = Group.objects.get_or_create(name=g)
-
-            if not group.system:
-                groups.append(group)
-
-        return groups
+        return [g for g in Group.get_or_create_many(values) if not g.system]
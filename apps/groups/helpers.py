@@ -4,6 +4,8 @@ from jingo import register
 @register.function
 def stringify_groups(groups):
     """
-    Change a list of Group (or skills) objects into a space-delimited string.
+    Change a list of Group (or skills) objects into a comma-delimited string.
+
+    Names work too, e.g. from ``values_list('name', flat=True)``.
     """
-    return u','.join([group.name for group in groups])
+    return u','.join([getattr(group, 'name', group) for group in groups])
@@ -1,9 +1,16 @@
-from django.db import models
+from collections import defaultdict
+
+from django.db import (IntegrityError, connection, models, router,
+                       transaction)
+from django.db.models import F
 from django.dispatch import receiver
 from django.template.defaultfilters import slugify
 
 from tower import ugettext_lazy as _lazy
 
+from common import indexing
+from groups import autocomplete
+
 # If ten or more users use a group, it will get auto-completed.
 AUTO_COMPLETE_COUNT = 10
 
@@ -20,25 +27,126 @@ class GroupBase(models.Model):
     auto_complete = models.BooleanField(db_index=True, default=False)
     always_auto_complete = models.BooleanField(default=False)
 
+    # Number of profiles using this Group/Skill.  Kept up to date by the
+    # m2m_changed handler in users.models and reconciled by a cron job.
+    member_count = models.PositiveIntegerField(db_index=True, default=0)
+
     class Meta:
         abstract = True
 
     @classmethod
     def search(cls, query, auto_complete_only=True):
-        if query:
-            return list(
-                cls.objects.filter(
-                    name__istartswith=query,
-                    auto_complete=auto_complete_only
-                ).values_list('name', flat=True)
-            )
-        return []
+        """
+        Names starting with ``query``.
+
+        Autocompleted names come from the in-process prefix index (see
+        :mod:`groups.autocomplete`), most used first.
+        """
+        if not query:
+            return []
+        if auto_complete_only:
+            return autocomplete.search(cls, query)
+        return list(cls.objects.filter(name__istartswith=query,
+                                       auto_complete=False)
+                               .values_list('name', flat=True))
+
+    @classmethod
+    def get_or_create_many(cls, names):
+        """
+        Return the objects called ``names``, creating the missing ones.
+
+        Names are lowercased; the result is in the order of ``names``,
+        without duplicates.  Existing names are looked up with one query and
+        missing ones inserted with one ``bulk_create`` (with the ``pre_save``
+        handlers applied by hand, since it doesn't send signals).
+        """
+        names = [n.lower() for n in names if n]
+        found = dict((obj.name, obj)
+                     for obj in cls.objects.filter(name__in=names))
+        missing = sorted(set(names) - set(found))
+        if missing:
+            new = [cls(name=n) for n in missing]
+            db = router.db_for_write(cls)
+            for obj in new:
+                models.signals.pre_save.send(sender=cls, instance=obj,
+                                             raw=False, using=db)
+            sid = transaction.savepoint(using=db)
+            try:
+                cls.objects.bulk_create(new)
+                transaction.savepoint_commit(sid, using=db)
+            except IntegrityError:
+                # Somebody else created some of them in the meantime.
+                transaction.savepoint_rollback(sid, using=db)
+                for n in missing:
+                    cls.objects.get_or_create(name=n)
+            found.update((obj.name, obj)
+                         for obj in cls.objects.filter(name__in=missing))
+
+        result = []
+        for n in names:
+            obj = found.pop(n, None)
+            if obj is not None:
+                result.append(obj)
+        return result
+
+    @classmethod
+    def merge(cls, target, others):
+        """
+        Move every membership of ``others`` to ``target`` and delete them.
+
+        Memberships are copied with one ``INSERT ... SELECT`` per relation
+        (profiles, and tasks for Groups), whatever the number of members.
+        The members' index documents are refreshed by the delete handlers.
+        """
+        others = [o.pk for o in others if o.pk != target.pk]
+        if not others:
+            return
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        for related in cls._meta.get_all_related_many_to_many_objects():
+            field = related.field
+            sql = dict(table=qn(field.m2m_db_table()),
+                       source=qn(field.m2m_column_name()),
+                       target=qn(field.m2m_reverse_name()),
+                       others=', '.join(['%s'] * len(others)))
+            cursor.execute('INSERT INTO %(table)s (%(source)s, %(target)s) '
+                           'SELECT DISTINCT o.%(source)s, %%s '
+                           'FROM %(table)s o LEFT JOIN %(table)s t '
+                           'ON t.%(source)s = o.%(source)s '
+                           'AND t.%(target)s = %%s '
+                           'WHERE o.%(target)s IN (%(others)s) '
+                           'AND t.%(source)s IS NULL' % sql,
+                           [target.pk, target.pk] + others)
+        cls.objects.filter(pk__in=others).delete()
+        (cls.objects.filter(pk=target.pk)
+                    .update(member_count=target.userprofile_set.count()))
 
     def __unicode__(self):
         """Return the name of this group, unless it doesn't have one yet."""
         return getattr(self, 'name', u'Unnamed')
 
 
+def change_member_counts(model, ids, step):
+    """
+    Add ``step`` to the ``member_count`` of ``model`` once for every time its
+    id appears in ``ids``; one ``UPDATE`` per distinct number of times.
+    """
+    # Counted by hand: collections.Counter is new in Python 2.7.
+    counts = defaultdict(int)
+    for id in ids:
+        counts[id] += 1
+    by_times = defaultdict(list)
+    for id, times in counts.iteritems():
+        by_times[times].append(id)
+    for times, ids in by_times.iteritems():
+        qs = model.objects.filter(id__in=ids)
+        if step < 0:
+            # Don't go below zero if the count has drifted.
+            qs.filter(member_count__lt=times).update(member_count=0)
+            qs = qs.filter(member_count__gte=times)
+        qs.update(member_count=F('member_count') + step * times)
+
+
 class Group(GroupBase):
     url = models.SlugField()
     system = models.BooleanField(db_index=True, default=False)
@@ -67,6 +175,51 @@ class Skill(GroupBase):
     pass
 
 
+class GroupSkillCount(models.Model):
+    """
+    How many members of ``group`` have ``skill``.
+
+    Materialized by the ``rebuild_group_skill_counts`` cron job so group
+    pages can read a group's most common skills from the
+    ``(group_id, count, skill_id)`` index (created by the migration).
+    """
+    group = models.ForeignKey(Group)
+    skill = models.ForeignKey(Skill)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        db_table = 'group_skill_count'
+        unique_together = ('group', 'skill')
+
+
+class GroupRelated(models.Model):
+    """
+    The groups and skills most related to ``group``, best first.
+
+    Computed offline by :mod:`groups.similarity` and stored as
+    comma-separated ids so a group page needs a single primary key lookup.
+    """
+    group = models.OneToOneField(Group, primary_key=True,
+                                 related_name='related')
+    groups = models.TextField(default='', blank=True)
+    skills = models.TextField(default='', blank=True)
+
+    class Meta:
+        db_table = 'group_related'
+
+    @staticmethod
+    def _lookup(model, ids):
+        ids = [int(i) for i in ids.split(',') if i]
+        objects = model.objects.in_bulk(ids)
+        return [objects[i] for i in ids if i in objects]
+
+    def related_groups(self):
+        return self._lookup(Group, self.groups)
+
+    def related_skills(self):
+        return self._lookup(Skill, self.skills)
+
+
 @receiver(models.signals.pre_save, sender=Group)
 def _create_url_slug(sender, instance, raw, using, **kwargs):
     """Create a Group's URL slug when it's first saved."""
@@ -79,3 +232,72 @@ def _create_url_slug(sender, instance, raw, using, **kwargs):
 def _lowercase_name(sender, instance, raw, using, **kwargs):
     """Convert any group's name to lowercase before it's saved."""
     instance.name = instance.name.lower()
+
+
+@receiver(models.signals.post_save, sender=Skill)
+@receiver(models.signals.post_save, sender=Group)
+def _update_autocomplete(sender, instance, created, raw, **kwargs):
+    """Rebuild the autocomplete index when its names may have changed."""
+    # New tags are created all the time by profile edits and only show up
+    # in autocomplete once the cron job promotes them.
+    if not created or instance.auto_complete:
+        autocomplete.invalidate(sender)
+
+
+@receiver(models.signals.post_delete, sender=Skill)
+@receiver(models.signals.post_delete, sender=Group)
+def _remove_from_autocomplete(sender, instance, **kwargs):
+    if instance.auto_complete:
+        autocomplete.invalidate(sender)
+
+
+def _members(instance):
+    """``{model: ids}`` of the profiles (and tasks) that have ``instance``."""
+    members = {}
+    for related in instance._meta.get_all_related_many_to_many_objects():
+        manager = getattr(instance, related.get_accessor_name())
+        members[related.model] = list(manager.values_list('id', flat=True))
+    return members
+
+
+def _reindex_members(members):
+    # Profile and task documents carry their group and skill names.
+    for model, ids in members.iteritems():
+        indexing.schedule_bulk_index(model, ids)
+
+
+@receiver(models.signals.post_init, sender=Skill)
+@receiver(models.signals.post_init, sender=Group)
+def _remember_name(sender, instance, **kwargs):
+    """Note the stored name, so a rename can be seen without a query."""
+    instance._stored_name = instance.name if instance.pk else None
+
+
+@receiver(models.signals.pre_save, sender=Skill)
+@receiver(models.signals.pre_save, sender=Group)
+def _check_renamed(sender, instance, raw, using, **kwargs):
+    """Remember whether an existing group or skill is being renamed."""
+    stored = getattr(instance, '_stored_name', None)
+    instance._renamed = bool(instance.pk and not raw and stored is not None
+                             and stored != instance.name)
+
+
+@receiver(models.signals.post_save, sender=Skill)
+@receiver(models.signals.post_save, sender=Group)
+def _reindex_renamed(sender, instance, **kwargs):
+    instance._stored_name = instance.name
+    if getattr(instance, '_renamed', False):
+        _reindex_members(_members(instance))
+
+
+@receiver(models.signals.pre_delete, sender=Skill)
+@receiver(models.signals.pre_delete, sender=Group)
+def _collect_members(sender, instance, **kwargs):
+    """Memberships are gone by post_delete, so note the members now."""
+    instance._members = _members(instance)
+
+
+@receiver(models.signals.post_delete, sender=Skill)
+@receiver(models.signals.post_delete, sender=Group)
+def _reindex_deleted(sender, instance, **kwargs):
+    _reindex_members(getattr(instance, '_members', {}))
@@ -0,0 +1,124 @@
+"""
+Related groups and skills, computed offline from the membership tables.
+
+The profile/group and profile/skill tables are loaded into sparse
+profiles x tags matrices ``G`` and ``S``.  ``G.T * G`` counts the members
+every pair of groups shares, which gives their Jaccard similarity, and
+``G.T * S`` counts the members of each group with each skill, which gives
+their cosine similarity.  Only pairs sharing at least :data:`MIN_SHARED`
+members are kept and the :data:`TOP_K` best of each group are stored in
+:class:`groups.models.GroupRelated`.
+
+This needs NumPy and SciPy (see ``requirements/compiled.txt``) and is only
+imported by the ``rebuild_related_groups`` cron job.
+"""
+from itertools import chain
+
+from django.db import transaction
+
+import numpy as np
+from scipy import sparse
+
+from groups.models import GroupRelated
+from users.models import UserProfile
+
+TOP_K = 10
+MIN_SHARED = 2
+BULK_CHUNK_SIZE = 500
+
+
+def load_memberships(through, column):
+    """Return the ``(profile id, tag id)`` rows of ``through`` as an array."""
+    rows = through.objects.values_list('userprofile', column)
+    pairs = np.fromiter(chain.from_iterable(rows.iterator()), dtype=np.int64)
+    return pairs.reshape(-1, 2)
+
+
+def membership_matrix(pairs, profiles):
+    """
+    Build the ``profiles`` x tags matrix of ``pairs``.
+
+    Rows are profile ids; returns the matrix and the tag id of each column.
+    """
+    tags, columns = np.unique(pairs[:, 1], return_inverse=True)
+    ones = np.ones(len(pairs))
+    matrix = sparse.csr_matrix((ones, (pairs[:, 0], columns)),
+                               shape=(profiles, len(tags)))
+    return matrix, tags
+
+
+def _column_sizes(matrix):
+    return np.asarray(matrix.sum(axis=0)).ravel()
+
+
+def jaccard(a):
+    """Jaccard similarity of every pair of columns of ``a``."""
+    shared = a.T.dot(a).tocoo()
+    keep = (shared.row != shared.col) & (shared.data >= MIN_SHARED)
+    rows, cols, both = shared.row[keep], shared.col[keep], shared.data[keep]
+    sizes = _column_sizes(a)
+    scores = both / (sizes[rows] + sizes[cols] - both)
+    return sparse.coo_matrix((scores, (rows, cols)), shape=shared.shape)
+
+
+def cosine(a, b):
+    """Cosine similarity of every column of ``a`` with every column of ``b``."""
+    shared = a.T.dot(b).tocoo()
+    keep = shared.data >= MIN_SHARED
+    rows, cols, both = shared.row[keep], shared.col[keep], shared.data[keep]
+    scores = both / np.sqrt(_column_sizes(a)[rows] * _column_sizes(b)[cols])
+    return sparse.coo_matrix((scores, (rows, cols)), shape=shared.shape)
+
+
+def top_k(scores, k):
+    """
+    Return ``{row: [column, ...]}`` with the ``k`` best columns of each row.
+
+    Ties are broken by column so the result doesn't depend on the order of
+    the sparse entries.
+    """
+    scores = scores.tocoo()
+    order = np.lexsort((scores.col, -scores.data, scores.row))
+    rows, cols = scores.row[order], scores.col[order]
+    # Position of every entry within its row.
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    best = {}
+    for row, col in zip(rows[rank < k], cols[rank < k]):
+        best.setdefault(row, []).append(col)
+    return best
+
+
+def related_tags(k=TOP_K):
+    """Return ``{group id: (related group ids, related skill ids)}``."""
+    group_pairs = load_memberships(UserProfile.groups.through, 'group')
+    skill_pairs = load_memberships(UserProfile.skills.through, 'skill')
+    if not len(group_pairs):
+        return {}
+    profiles = 1 + max(int(p[:, 0].max())
+                       for p in (group_pairs, skill_pairs) if len(p))
+    groups, group_ids = membership_matrix(group_pairs, profiles)
+    related_groups = top_k(jaccard(groups), k)
+    related_skills = {}
+    if len(skill_pairs):
+        skills, skill_ids = membership_matrix(skill_pairs, profiles)
+        related_skills = top_k(cosine(groups, skills), k)
+
+    related = {}
+    for row in set(related_groups) | set(related_skills):
+        related[int(group_ids[row])] = (
+            [int(group_ids[c]) for c in related_groups.get(row, [])],
+            [int(skill_ids[c]) for c in related_skills.get(row, [])])
+    return related
+
+
+@transaction.commit_on_success
+def rebuild(k=TOP_K):
+    """Replace every :class:`GroupRelated` row; returns how many there are."""
+    related = related_tags(k)
+    rows = [GroupRelated(group_id=id, groups=','.join(map(str, groups)),
+                         skills=','.join(map(str, skills)))
+            for id, (groups, skills) in related.iteritems()]
+    GroupRelated.objects.all().delete()
+    for i in xrange(0, len(rows), BULK_CHUNK_SIZE):
+        GroupRelated.objects.bulk_create(rows[i:i + BULK_CHUNK_SIZE])
+    return len(rows)
@@ -7,9 +7,15 @@ from nose.tools import eq_
 from pyquery import PyQuery as pq
 
 import common.tests
-from groups.cron import assign_autocomplete_to_groups
+from common import search
+from groups.cron import (assign_autocomplete_to_groups,
+                         rebuild_group_skill_counts, rebuild_related_groups,
+                         reconcile_member_counts)
+from groups.forms import GroupWidget
 from groups.helpers import stringify_groups
-from groups.models import AUTO_COMPLETE_COUNT, Group
+from groups.models import AUTO_COMPLETE_COUNT, Group, Skill
+from taskboard.models import Task
+from users.models import UserProfile
 
 
 class GroupTest(common.tests.TestCase):
@@ -50,6 +56,35 @@ class GroupTest(common.tests.TestCase):
 
         assert 'daft_punk' in json.loads(r.content)
 
+    def test_autocomplete_ranking(self):
+        """Autocomplete is served from memory, most used names first."""
+        quiet = Group.objects.create(name='daft quiet', auto_complete=True)
+        loud = Group.objects.create(name='daft loud', auto_complete=True)
+        Group.objects.create(name='daft hidden')
+        self.mozillian.get_profile().groups.add(loud)
+        eq_(Group.search('daft'), ['daft loud', 'daft quiet'])
+
+        with self.assertNumQueries(0):
+            eq_(Group.search('DAFT Q'), ['daft quiet'])
+            eq_(Group.search('punk'), [])
+
+        quiet.delete()
+        eq_(Group.search('daft'), ['daft loud'])
+
+    def test_autocomplete_demotion(self):
+        """Unused groups lose autocomplete unless it is forced on."""
+        Group.objects.create(name='faded', auto_complete=True)
+        Group.objects.create(name='forced', auto_complete=True,
+                             always_auto_complete=True)
+        Group.objects.create(name='systemic', auto_complete=True, system=True)
+
+        report = assign_autocomplete_to_groups()
+        assert '1 groups and 0 skills removed' in report, report
+        names = ['faded', 'forced', 'systemic']
+        eq_(set(Group.objects.filter(name__in=names, auto_complete=True)
+                             .values_list('name', flat=True)),
+            set(['forced', 'systemic']))
+
     def test_groups_are_always_lowercase(self):
         """Ensure all groups are saved with lowercase names only."""
         Group.objects.create(name='lowercase')
@@ -227,3 +262,162 @@ class GroupTest(common.tests.TestCase):
         assert not profile.groups.filter(id=self.SYSTEM_GROUP.id), (
                 'User should not be in the "%s" group' %
                 self.SYSTEM_GROUP.name)
+
+    def test_member_list_cursor(self):
+        """Walk a group's members page by page with the AJAX cursor."""
+        for i, name in enumerate(('Bea', 'Ann', 'Cat', 'Ann', 'Dee')):
+            u = User.objects.create(email='cursor%d@example.com' % i,
+                                    username='cursor%d' % i,
+                                    first_name=name, last_name='Cursor')
+            u.get_profile().groups.add(self.NORMAL_GROUP)
+
+        url = reverse('group', args=[self.NORMAL_GROUP.id,
+                                     self.NORMAL_GROUP.url])
+        r = self.mozillian_client.get(url, dict(limit=2))
+        seen = [p.id for p in r.context['people']]
+        cursor = first_cursor = r.context['next_cursor']
+        while cursor:
+            r = self.mozillian_client.get(
+                url, dict(limit=2, cursor=cursor),
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            seen.extend(p.id for p in r.context['people'])
+            cursor = r.context['next_cursor']
+
+        expected = (self.NORMAL_GROUP.userprofile_set
+                                     .order_by('display_name', 'id'))
+        eq_(seen, [p.id for p in expected])
+
+        # Without JavaScript the cursor still gives the next page.
+        r = self.mozillian_client.get(url, dict(limit=2, cursor=first_cursor))
+        eq_(r.context['group'], self.NORMAL_GROUP)
+        eq_([p.id for p in r.context['people']],
+            [p.id for p in expected][2:4])
+
+    def test_member_count(self):
+        """member_count follows adds, removals, clears and deletions."""
+        def count():
+            return Group.objects.get(id=self.NORMAL_GROUP.id).member_count
+
+        moz = self.mozillian.get_profile()
+        pending = self.pending.get_profile()
+        moz.groups.add(self.NORMAL_GROUP)
+        moz.groups.add(self.NORMAL_GROUP)
+        eq_(count(), 1)
+        self.NORMAL_GROUP.userprofile_set.add(pending)
+        eq_(count(), 2)
+
+        pending.groups.remove(self.NORMAL_GROUP, self.SYSTEM_GROUP)
+        pending.groups.remove(self.NORMAL_GROUP)
+        eq_(count(), 1)
+        self.NORMAL_GROUP.userprofile_set.add(pending)
+        self.NORMAL_GROUP.userprofile_set.clear()
+        eq_(count(), 0)
+
+        moz.groups.add(self.NORMAL_GROUP)
+        moz.delete()
+        eq_(count(), 0)
+
+    def test_reconcile_member_counts(self):
+        self.mozillian.get_profile().groups.add(self.NORMAL_GROUP)
+        Group.objects.update(member_count=7)
+
+        assert 'fixed' in reconcile_member_counts()
+        eq_(Group.objects.get(id=self.NORMAL_GROUP.id).member_count, 1)
+        eq_(Group.objects.get(id=self.SYSTEM_GROUP.id).member_count, 0)
+
+    def test_steward_group_skills(self):
+        """Stewarded group pages list the skills most members have."""
+        group = self.NORMAL_GROUP
+        group.steward = self.mozillian.get_profile()
+        group.save()
+        python, css, rust = [Skill.objects.create(name=n)
+                             for n in ('python', 'css', 'rust')]
+        for i, skills in enumerate([(python, css), (css,), (rust,)]):
+            u = User.objects.create(email='skilled%d@example.com' % i,
+                                    username='skilled%d' % i)
+            profile = u.get_profile()
+            profile.skills.add(*skills)
+            if i < 2:
+                profile.groups.add(group)
+
+        rebuild_group_skill_counts()
+        r = self.mozillian_client.get(reverse('group', args=[group.id,
+                                                             group.url]))
+        eq_(r.context['skills'], ['css', 'python'])
+
+    def test_related_groups(self):
+        """Groups sharing members are related; so are their skills."""
+        a, b, c = [Group.objects.create(name=n) for n in ('aa', 'bb', 'cc')]
+        python = Skill.objects.create(name='python')
+        for i, groups in enumerate([(a, b), (a, b, c), (c,)]):
+            u = User.objects.create(email='related%d@example.com' % i,
+                                    username='related%d' % i)
+            profile = u.get_profile()
+            profile.groups.add(*groups)
+            if i < 2:
+                profile.skills.add(python)
+
+        rebuild_related_groups()
+        r = self.mozillian_client.get(reverse('group', args=[a.id, a.url]))
+        eq_(r.context['related_groups'], [b])
+        eq_(r.context['related_skills'], [python])
+
+        r = self.mozillian_client.get(reverse('group', args=[c.id, c.url]))
+        assert 'related_groups' not in r.context
+
+    def test_group_widget_renders_in_one_query(self):
+        groups = [Group.objects.create(name=n) for n in ('zz', 'aa', 'mm')]
+        value = [g.id for g in groups] + [-1]
+        with self.assertNumQueries(1):
+            html = GroupWidget().render('groups', value)
+        eq_(pq(html).attr('value'), 'zz,aa,mm')
+        eq_(stringify_groups(['aa', groups[2]]), 'aa,mm')
+
+    def test_renamed_group_is_reindexed(self):
+        profile = self.mozillian.get_profile()
+        profile.groups.add(self.NORMAL_GROUP)
+        # Build the local index before the rename.
+        eq_(list(UserProfile.search('cheesezilla')), [profile])
+
+        group = Group.objects.get(id=self.NORMAL_GROUP.id)
+        group.name = 'Fondue'
+        group.save()
+        assert group._renamed
+        eq_(list(UserProfile.search('fondue')), [profile])
+        eq_(list(UserProfile.search('cheesezilla')), [])
+        # Saving it again is not a rename.
+        group.save()
+        eq_(group._renamed, False)
+
+        self.NORMAL_GROUP.delete()
+        eq_(list(UserProfile.search('fondue')), [])
+
+    def test_renamed_group_is_reindexed_in_tasks(self):
+        task = Task.objects.create(contact=self.mozillian.get_profile(),
+                                   summary='Melt cheese')
+        task.groups.add(self.NORMAL_GROUP)
+        index = search.get_index(Task)
+        eq_(index.document(task.id)['groups'], ['cheesezilla'])
+
+        group = Group.objects.get(id=self.NORMAL_GROUP.id)
+        group.name = 'Fondue'
+        group.save()
+        eq_(index.document(task.id)['groups'], ['fondue'])
+
+        group.delete()
+        eq_(index.document(task.id)['groups'], [])
+
+    def test_merge(self):
+        other = Group.objects.create(name='cheeselovers')
+        task = Task.objects.create(contact=self.pending.get_profile(),
+                                   summary='Eat cheese')
+        task.groups.add(other)
+        self.mozillian.get_profile().groups.add(self.NORMAL_GROUP, other)
+        self.pending.get_profile().groups.add(other)
+
+        Group.merge(self.NORMAL_GROUP, [other])
+        assert not Group.objects.filter(name='cheeselovers').exists()
+        eq_(set(self.NORMAL_GROUP.userprofile_set.all()),
+            set([self.mozillian.get_profile(), self.pending.get_profile()]))
+        eq_(list(task.groups.all()), [self.NORMAL_GROUP])
+        eq_(Group.objects.get(id=self.NORMAL_GROUP.id).member_count, 2)
@@ -2,7 +2,6 @@ import json
 
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.db.models import Count
 from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.views.decorators.cache import cache_control
@@ -11,13 +10,19 @@ from django.views.decorators.http import require_POST
 import commonware.log
 from funfactory.urlresolvers import reverse
 
-from groups.models import Group, Skill
+from common import pagination
+from groups.models import Group, GroupRelated, GroupSkillCount
 from phonebook import forms
 from phonebook.views import vouch_required
-from users.models import UserProfile
 
 log = commonware.log.getLogger('m.groups')
 
+# Member lists are ordered (and keyset-paginated) by these fields.
+MEMBER_ORDERING = ('display_name', 'id')
+
+# How many common skills are listed on a stewarded group's page.
+TOP_SKILLS = 15
+
 
 @login_required
 def index(request):
@@ -64,24 +69,41 @@ def show(request, id, url=None):
     if form.is_valid():
         limit = form.cleaned_data['limit']
 
-    in_group = (request.user.get_profile()
-                            .groups.filter(id=group.id).count())
+    limit = int(limit)
+    cursor = request.GET.get('cursor')
     profiles = group.userprofile_set.all()
-    page = request.GET.get('page', 1)
-    paginator = Paginator(profiles, limit)
-    people = []
-    try:
-        people = paginator.page(page)
-    except PageNotAnInteger:
-        people = paginator.page(1)
-    except EmptyPage:
-        people = paginator.page(paginator.num_pages)
 
+    in_group = (request.user.get_profile()
+                            .groups.filter(id=group.id).count())
     show_pagination = False
     num_pages = 0
-    if paginator.count > forms.PAGINATION_LIMIT:
-        show_pagination = True
-        num_pages = len(people.paginator.page_range)
+
+    if cursor is not None:
+        # Infinite scroll: seek past the cursor instead of counting.
+        people = pagination.keyset_page(profiles, MEMBER_ORDERING, cursor,
+                                        limit)
+        next_cursor = people.next_cursor
+    else:
+        page = request.GET.get('page', 1)
+        paginator = Paginator(profiles.order_by(*MEMBER_ORDERING), limit)
+        people = []
+        try:
+            people = paginator.page(page)
+        except PageNotAnInteger:
+            people = paginator.page(1)
+        except EmptyPage:
+            people = paginator.page(paginator.num_pages)
+
+        # Evaluate the page once, for both the template and the cursor.
+        people.object_list = list(people.object_list)
+        next_cursor = None
+        if people.has_next():
+            next_cursor = pagination.keyset_cursor(people.object_list[-1],
+                                                   MEMBER_ORDERING)
+
+        if paginator.count > forms.PAGINATION_LIMIT:
+            show_pagination = True
+            num_pages = len(people.paginator.page_range)
 
     d = dict(people=people,
              group=group,
@@ -90,14 +112,23 @@ def show(request, id, url=None):
              limit=limit,
              show_pagination=show_pagination,
              num_pages=num_pages,
-             members=UserProfile.objects.filter(group=group).count())
+             next_cursor=next_cursor,
+             members=group.member_count)
+
+    try:
+        related = GroupRelated.objects.get(pk=group.id)
+        d.update(related_groups=related.related_groups(),
+                 related_skills=related.related_skills())
+    except GroupRelated.DoesNotExist:
+        pass
 
     if group.steward:
-        # Get the 15 most globally popular skills that apear in the group
-        skills = [s.name for s in Skill.objects
-                                       .filter(userprofile__group__id=group.id)
-                                       .annotate(users=Count('userprofile'))
-                                       .order_by('users')][:15]
+        # The 15 skills most members of the group have (see the
+        # rebuild_group_skill_counts cron job).
+        skills = list(GroupSkillCount.objects.filter(group=group)
+                                     .order_by('-count', '-skill')
+                                     .values_list('skill__name', flat=True)
+                                     [:TOP_SKILLS])
         d.update(skills=skills)
         d.update(irc_channels=group.irc_channel.split(' '))
 
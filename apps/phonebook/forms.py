@@ -9,6 +9,7 @@ from django.utils.safestring import mark_safe
 import happyforms
 from tower import ugettext as _, ugettext_lazy as _lazy
 
+from common.uploads import image_dimensions
 from phonebook.models import Invite
 from groups.models import Group, Skill
 from users.models import User, UserProfile
@@ -45,6 +46,36 @@ class UsernameWidget(forms.widgets.Input):
                 super(UsernameWidget, self).render(*args, **kwargs))
 
 
+class PhotoField(forms.FileField):
+    """
+    A photo upload, validated without decoding it.
+
+    Checks the size against ``MAX_PHOTO_UPLOAD_SIZE`` and reads only the
+    image header for the dimensions; see :mod:`common.uploads`.
+    """
+    default_error_messages = {
+        'too_large': _lazy(u'Please upload a photo smaller than %(size)d MB.'),
+        'invalid_image': _lazy(u'Please upload a JPEG, PNG or GIF image.'),
+        'too_many_pixels': _lazy(u'This photo has too many pixels; please '
+                                 'upload a smaller one.'),
+    }
+
+    def to_python(self, data):
+        f = super(PhotoField, self).to_python(data)
+        if f is None:
+            return None
+        if f.size > settings.MAX_PHOTO_UPLOAD_SIZE:
+            raise forms.ValidationError(self.error_messages['too_large'] % {
+                'size': settings.MAX_PHOTO_UPLOAD_SIZE // (1024 ** 2)})
+        dimensions = image_dimensions(f)
+        if not dimensions or not all(dimensions):
+            raise forms.ValidationError(self.error_messages['invalid_image'])
+        if dimensions[0] * dimensions[1] > settings.MAX_PHOTO_PIXELS:
+            raise forms.ValidationError(
+                self.error_messages['too_many_pixels'])
+        return f
+
+
 class UserForm(forms.ModelForm):
     """
     Instead of just inhereting form a UserProfile model form, this base class
@@ -105,7 +136,7 @@ class UserForm(forms.ModelForm):
 
 
 class ProfileForm(UserForm):
-    photo = forms.ImageField(label=_lazy(u'Profile Photo'), required=False)
+    photo = PhotoField(label=_lazy(u'Profile Photo'), required=False)
     photo_delete = forms.BooleanField(label=_lazy(u'Remove Profile Photo'),
                                       required=False)
 
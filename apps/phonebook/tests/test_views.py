@@ -1,4 +1,5 @@
 import os
+import tempfile
 from uuid import uuid4
 
 from django import test
@@ -6,9 +7,11 @@ from django.contrib.auth.models import User
 
 import test_utils
 from nose.tools import eq_
+from PIL import Image
 from pyquery import PyQuery as pq
 
 from common.tests import TestCase, ESTestCase
+from common.uploads import image_dimensions
 from funfactory.urlresolvers import set_url_prefix, reverse
 
 
@@ -255,8 +258,11 @@ class TestViews(TestCase):
 
         f.close()
 
-        f = open(os.path.join(os.path.dirname(__file__), 'profile-photo.jpg'),
-                 'rb')
+        # Uploading the same picture again doesn't change anything, so the
+        # replacement has to be a different one.
+        f = tempfile.NamedTemporaryFile(suffix='.jpg')
+        Image.new('RGB', (400, 300), 'red').save(f, 'JPEG')
+        f.seek(0)
         doc = pq(r.content)
         old_photo = doc('#profile-photo').attr('src')
         r = client.post(reverse('profile.edit'),
@@ -396,6 +402,63 @@ class TestSearch(ESTestCase):
         self.assertEqual(len(peeps), 2)
 
 
+def _photo(size=(400, 300), format='JPEG'):
+    f = tempfile.NamedTemporaryFile(suffix='.' + format.lower())
+    Image.new('RGB', size, 'red').save(f, format)
+    f.seek(0)
+    return f
+
+
+class TestPhotoUploads(TestCase):
+
+    def post_photo(self, f):
+        return self.mozillian_client.post(reverse('profile.edit'),
+                                          dict(last_name='foo', photo=f))
+
+    def test_image_dimensions(self):
+        for format in ('JPEG', 'PNG', 'GIF'):
+            f = _photo((123, 45), format)
+            eq_(image_dimensions(f), (123, 45))
+            eq_(f.tell(), 0)
+        png = _photo((123, 45), 'PNG').read(17)
+        for data in ('not an image', 'GIF89a\x01', png, '\xff\xd8\xff'):
+            f = tempfile.TemporaryFile()
+            f.write(data)
+            eq_(image_dimensions(f), None)
+
+    def test_oversized_photo_is_rejected(self):
+        with self.settings(MAX_PHOTO_UPLOAD_SIZE=1000):
+            r = self.post_photo(_photo())
+        eq_(r.status_code, 200)
+        assert pq(r.content)('.error'), 'The form should show an error.'
+        assert not self.mozillian.get_profile().photo
+
+    def test_too_many_pixels(self):
+        with self.settings(MAX_PHOTO_PIXELS=1000):
+            r = self.post_photo(_photo())
+        eq_(r.status_code, 200)
+        assert not self.mozillian.get_profile().photo
+
+    def test_not_an_image(self):
+        # Has the GIF magic, but is cut off before the dimensions.
+        f = tempfile.NamedTemporaryFile(suffix='.jpg')
+        f.write('GIF89a\x01')
+        f.seek(0)
+        r = self.post_photo(f)
+        eq_(r.status_code, 200)
+        assert pq(r.content)('.error'), 'The form should show an error.'
+        assert not self.mozillian.get_profile().photo
+
+    def test_request_too_large(self):
+        with self.settings(MAX_UPLOAD_REQUEST_SIZE=1000):
+            r = self.post_photo(_photo())
+        eq_(r.status_code, 413)
+
+    def test_valid_photo(self):
+        eq_(self.post_photo(_photo()).status_code, 302)
+        assert self.mozillian.get_profile().photo
+
+
 def _logged_in_html(response):
     doc = pq(response.content)
     return doc('a#logout')
@@ -4,7 +4,7 @@ from django.contrib import messages
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.paginator import EmptyPage, PageNotAnInteger
 from django.http import HttpResponseRedirect, HttpResponseForbidden
 from django.shortcuts import redirect, render
 from django.views.decorators.cache import cache_page, never_cache
@@ -14,10 +14,11 @@ import commonware.log
 from funfactory.urlresolvers import reverse
 from tower import ugettext as _
 
+from common import pagination
 from groups.helpers import stringify_groups
 from phonebook import forms
 from phonebook.models import Invite
-from users.models import UserProfile
+from users.models import SimilarProfiles, UserProfile
 
 log = commonware.log.getLogger('m.phonebook')
 
@@ -57,6 +58,12 @@ def profile(request, username):
         vouch_form = forms.VouchForm(initial=dict(vouchee=profile.pk))
 
     data = dict(shown_user=user, profile=profile, vouch_form=vouch_form)
+    if request.user.get_profile().is_vouched:
+        try:
+            similar = SimilarProfiles.objects.get(pk=profile.pk)
+            data['similar_profiles'] = similar.similar_profiles()
+        except SimilarProfiles.DoesNotExist:
+            pass
     return render(request, 'phonebook/profile.html', data)
 
 
@@ -64,8 +71,10 @@ def profile(request, username):
 @login_required
 def edit_profile(request):
     profile = request.user.get_profile()
-    user_groups = stringify_groups(profile.groups.all().order_by('name'))
-    user_skills = stringify_groups(profile.skills.all().order_by('name'))
+    user_groups = stringify_groups(profile.groups.order_by('name')
+                                          .values_list('name', flat=True))
+    user_skills = stringify_groups(profile.skills.order_by('name')
+                                          .values_list('name', flat=True))
 
     if request.method == 'POST':
         form = forms.ProfileForm(
@@ -138,35 +147,47 @@ def search(request):
     nonvouched_only = False
     people = []
     show_pagination = False
+    next_cursor = None
     form = forms.SearchForm(request.GET)
 
     if form.is_valid():
         query = form.cleaned_data.get('q', '')
-        limit = form.cleaned_data['limit']
+        limit = int(form.cleaned_data['limit'])
         vouched = False if form.cleaned_data['nonvouched_only'] else None
         page = request.GET.get('page', 1)
+        cursor = request.GET.get('cursor')
+
+        profiles = UserProfile.search(query, vouched=vouched,
+                                      source_only=True)
 
-        profiles = UserProfile.search(query, vouched=vouched)
+        if cursor is not None:
+            # Infinite scroll: no count, just the page after the cursor.
+            people = pagination.search_page(profiles, cursor, limit)
+            next_cursor = people.next_cursor
+        else:
+            paginator = pagination.SearchPaginator(profiles, limit)
 
-        paginator = Paginator(profiles, limit)
+            try:
+                people = paginator.page(page)
+            except PageNotAnInteger:
+                people = paginator.page(1)
+            except EmptyPage:
+                people = paginator.page(paginator.num_pages)
 
-        try:
-            people = paginator.page(page)
-        except PageNotAnInteger:
-            people = paginator.page(1)
-        except EmptyPage:
-            people = paginator.page(paginator.num_pages)
+            if people.has_next():
+                next_cursor = pagination.offset_cursor(people.end_index())
 
-        if paginator.count > forms.PAGINATION_LIMIT:
-            show_pagination = True
-            num_pages = len(people.paginator.page_range)
+            if paginator.count > forms.PAGINATION_LIMIT:
+                show_pagination = True
+                num_pages = len(people.paginator.page_range)
 
     d = dict(people=people,
              form=form,
              limit=limit,
              nonvouched_only=nonvouched_only,
              show_pagination=show_pagination,
-             num_pages=num_pages)
+             num_pages=num_pages,
+             next_cursor=next_cursor)
 
     if request.is_ajax():
         return render(request, 'search_ajax.html', d)
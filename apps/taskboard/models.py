@@ -4,10 +4,10 @@ from django.db import models
 from django.db.models import signals as dbsignals
 from django.dispatch import receiver
 
-from elasticutils import S
 from elasticutils.models import SearchMixin
 from tower import ugettext_lazy as _
 
+from common import indexing, search
 from users.models import UserProfile
 
 
@@ -33,9 +33,30 @@ class Task(SearchMixin, models.Model):
         return u'{0} ({1})'.format(self.summary, self.contact)
 
     def fields(self):
-        attrs = ('id', 'summary', 'instructions', 'deadline',
-                 'created', 'disabled')
-        return dict((a, getattr(self, a)) for a in attrs)
+        return self.index_documents([self.id])[self.id]
+
+    @classmethod
+    def index_documents(cls, ids, fields=None):
+        """
+        Build the search index documents for the tasks in ``ids``.
+
+        Two queries: the tasks and their group names.  With ``fields``
+        (only ``groups`` is supported) just the group names are built, for
+        every id in ``ids``.
+        """
+        if fields is None:
+            attrs = ('id', 'summary', 'instructions', 'deadline',
+                     'created', 'disabled')
+            docs = dict((row[0], dict(zip(attrs, row), groups=[]))
+                        for row in (cls.objects.filter(id__in=ids)
+                                               .values_list(*attrs)))
+        else:
+            docs = dict((id, {'groups': []}) for id in ids)
+        rows = (cls.groups.through.objects.filter(task__in=docs.keys())
+                                          .values_list('task', 'group__name'))
+        for task_id, name in rows:
+            docs[task_id]['groups'].append(name)
+        return docs
 
     @classmethod
     def search(cls, query):
@@ -43,18 +64,24 @@ class Task(SearchMixin, models.Model):
         fields = ('summary__text', 'summary__startswith',
                   'instructions__text')
         q = dict((field, query) for field in fields)
-        s = S(cls).query(or_=q).filter(disabled=False)
+        s = search.get_search(cls).query(or_=q).filter(disabled=False)
         return s
 
 
 @receiver(dbsignals.post_save, sender=Task)
 def update_search_index(sender, instance, **kw):
-    from elasticutils import tasks as es_tasks
-    es_tasks.index_objects.delay(Task, [instance.id])
+    indexing.schedule_index(Task, [instance.id])
+
+
+# Adding and removing groups doesn't save the task.
+@receiver(dbsignals.m2m_changed, sender=Task.groups.through)
+def update_groups_in_search_index(sender, **kw):
+    indexing.schedule_m2m_update(Task, 'groups', **kw)
 
 
 # This may not be used. Thats ok; it allows us to use Task.delete()
 @receiver(dbsignals.post_delete, sender=Task)
 def remove_from_search_index(sender, instance, **kw):
-    from elasticutils import tasks as es_tasks
-    es_tasks.unindex_objects.delay(sender, [instance.id])
+    from common import tasks
+    indexing.coalescer.discard(Task, [instance.id])
+    tasks.unindex_objects.delay(sender, [instance.id])
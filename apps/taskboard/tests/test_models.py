@@ -1,5 +1,6 @@
 from funfactory.urlresolvers import reverse
 
+from common import indexing
 from common.tests import TestCase
 from groups.models import Group
 from taskboard.models import Task
@@ -45,3 +46,15 @@ class TaskTest(TestCase):
         t2 = Task.objects.get(pk=t.pk)
         t2_groups = set(g.name for g in t2.groups.all())
         self.assertSetEqual(set(['stuff', 'whatnot', 'staff']), t2_groups)
+
+    def test_group_changes_update_index_document(self):
+        t = Task.objects.create(summary='Testing',
+                                contact=self.mozillian.get_profile())
+        group = Group.objects.create(name='taskforce')
+        with indexing.coalesced() as coalescer:
+            t.groups.add(group)
+            self.assertEqual(coalescer.partial,
+                             {Task: {t.id: set(['groups'])}})
+        self.assertEqual(Task.index_documents([t.id], ['groups']),
+                         {t.id: {'groups': ['taskforce']}})
+        self.assertEqual(t.fields()['groups'], ['taskforce'])
@@ -1,18 +1,255 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import connection
+
 import commonware.log
 import cronjobs
-from celery.task.sets import TaskSet
-from celeryutils import chunked
 
-from users.models import UserProfile
+from common import indexing, thumbnails
+from users.models import (PHOTO_SIZES, UserProfile, fs, photo_path,
+                          rendition_name)
 
 log = commonware.log.getLogger('m.cron')
 
 
 @cronjobs.register
 def index_all_profiles():
-    from elasticutils import tasks
+    """Stream every profile into the search index over the _bulk API."""
+    report = indexing.bulk_index(UserProfile)
+    sys.stdout.write('%s\n' % report)
+
+
+def _processes(processes):
+    return int(processes) if processes else None
+
+
+@cronjobs.register
+def rebuild_similar_profiles(processes=None):
+    """Nightly job to recompute every profile's similar profiles."""
+    # Imported here so the other jobs don't need NumPy and SciPy.
+    from users import similar
+
+    start = time.time()
+    count = similar.update(processes=_processes(processes))
+    log.info('Similar profiles: stored %d profiles in %.2fs.' %
+             (count, time.time() - start))
+
+
+@cronjobs.register
+def update_similar_profiles(processes=None):
+    """Hourly job to recompute the similar profiles of changed profiles."""
+    from users import similar
+
+    start = time.time()
+    count = similar.update(incremental=True,
+                           processes=_processes(processes))
+    log.info('Similar profiles: updated %d profiles in %.2fs.' %
+             (count, time.time() - start))
+
+
+@cronjobs.register
+def benchmark_similar_profiles(profiles='100000', processes=None):
+    """Time the similar profiles computation on a synthetic directory."""
+    import json
+    from users import similar
+
+    report = similar.benchmark(int(profiles),
+                               processes=_processes(processes))
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+
+@cronjobs.register
+def process_photos():
+    """Queue the photos that have no renditions yet for processing."""
+    from users import tasks
+
+    photos = (UserProfile.objects.exclude(photo='').filter(photo_hash='')
+                                 .values_list('id', 'photo'))
+    count = 0
+    for id, name in photos.iterator():
+        tasks.process_photo.delay(id, name)
+        count += 1
+    log.info('Queued %d photos for processing.' % count)
+
+
+#: Photo names in the layout of ``users.models.photo_path``.
+SHARDED_PHOTO_RE = re.compile(r'^photos/[0-9a-f]{2}/[0-9a-f]{2}/')
+HASHED_PHOTO_RE = re.compile(r'^photos/([0-9a-f]{40})(\.\w+)?$')
+
+
+def _photo_digest(name, photo_hash):
+    """The SHA-1 of the stored photo ``name``, or None if it is missing."""
+    match = HASHED_PHOTO_RE.match(name)
+    if match:
+        return match.group(1)
+    if photo_hash:
+        return photo_hash
+    if not fs.exists(name):
+        return None
+    sha = hashlib.sha1()
+    f = fs.open(name)
+    try:
+        for chunk in f.chunks():
+            sha.update(chunk)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+
+def _copy_photo(old, new):
+    """
+    Give the stored file ``old`` the name ``new`` as well.
+
+    A hard link where the file system allows it, otherwise a copy that is
+    renamed into place once complete.  Names are content hashes, so if
+    ``new`` exists already (a duplicate, or a run that was stopped) it is
+    kept as it is.
+    """
+    if not fs.exists(old) or fs.exists(new):
+        return
+    path = fs.path(new)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    try:
+        os.link(fs.path(old), path)
+    except OSError:
+        tmp = '%s.tmp' % path
+        shutil.copyfile(fs.path(old), tmp)
+        os.rename(tmp, path)
+
+
+@cronjobs.register
+def migrate_photos(batch_size='200', per_second='20', start='0'):
+    """
+    Copy stored photos into the sharded ``photos/ab/cd/`` layout.
+
+    Profiles are walked in id order, ``batch_size`` at a time and no more
+    than ``per_second`` per second.  A photo is linked (or copied) to its
+    new name along with its renditions before the ``photo`` column of every
+    profile using it is rewritten.  The old files stay until
+    :func:`sweep_legacy_photos` removes them, so the job can be stopped at
+    any point and run again (from id ``start``, which the log reports after
+    each batch), and a profile saved by a form loaded before the move still
+    points at a file.
+    """
+    batch_size, per_second = int(batch_size), float(per_second)
+    last, moved = int(start), 0
+    while True:
+        started = time.time()
+        rows = list(UserProfile.objects.exclude(photo='')
+                                       .filter(id__gt=last).order_by('id')
+                                       .values_list('id', 'photo',
+                                                    'photo_hash')
+                                       [:batch_size])
+        if not rows:
+            break
+        last = rows[-1][0]
+        changed = []
+        for id, name, photo_hash in rows:
+            if SHARDED_PHOTO_RE.match(name):
+                continue
+            digest = _photo_digest(name, photo_hash)
+            if digest is None:
+                log.warning('Photo %s of profile %d is missing.' % (name, id))
+                continue
+            new = photo_path(digest, name)
+            for size in PHOTO_SIZES:
+                _copy_photo(rendition_name(name, size),
+                            rendition_name(new, size))
+            _copy_photo(name, new)
+            if not fs.exists(new):
+                log.warning('Could not copy photo %s of profile %d.' %
+                            (name, id))
+                continue
+            profiles = UserProfile.objects.filter(photo=name)
+            changed.extend(profiles.values_list('id', flat=True))
+            profiles.update(photo=new)
+            moved += 1
+        indexing.schedule_bulk_index(UserProfile, changed)
+        log.info('Moved %d photos; last profile id %d.' % (moved, last))
+        pause = len(rows) / per_second - (time.time() - started)
+        if pause > 0:
+            time.sleep(pause)
+
+
+#: Where photos were stored before the sharded layout.
+LEGACY_PHOTO_DIRS = ('userprofile', 'photos')
+
+
+@cronjobs.register
+def sweep_legacy_photos():
+    """
+    Remove the old files of photos :func:`migrate_photos` has copied.
+
+    A file in one of :data:`LEGACY_PHOTO_DIRS` goes, with its renditions,
+    once its sharded copy exists and no profile refers to it any more.  Run
+    it well after ``migrate_photos`` (a day, say), so profile forms opened
+    before the move have been submitted; a profile that was saved with an
+    old name again keeps its file and is picked up by the next
+    ``migrate_photos`` run.
+    """
+    referenced = set(n for n in UserProfile.objects.exclude(photo='')
+                                           .values_list('photo', flat=True)
+                     if not SHARDED_PHOTO_RE.match(n))
+    removed = 0
+    for directory in LEGACY_PHOTO_DIRS:
+        if not fs.exists(directory):
+            continue
+        for filename in fs.listdir(directory)[1]:
+            name = '%s/%s' % (directory, filename)
+            if name in referenced:
+                continue
+            digest = _photo_digest(name, None)
+            if not digest or not fs.exists(photo_path(digest, name)):
+                continue
+            for size in PHOTO_SIZES:
+                if fs.exists(rendition_name(name, size)):
+                    fs.delete(rendition_name(name, size))
+            fs.delete(name)
+            removed += 1
+    log.info('Removed %d migrated photos.' % removed)
+
+
+#: Photos handed to a worker process at a time by regenerate_thumbnails.
+THUMBNAIL_CHUNK_SIZE = 100
+
+#: Default images templates ask the thumbnail helper for.
+DEFAULT_THUMBNAIL_SOURCES = ('img/unknown.png',)
+
+
+def _generate_thumbnails(names):
+    thumbnails.generate_all([thumbnails.StoredFile(fs, name)
+                             for name in names])
+    return len(names)
+
+
+@cronjobs.register
+def regenerate_thumbnails(processes=None):
+    """Generate every registered thumbnail of every photo in a pool."""
+    start = time.time()
+    names = sorted(set(UserProfile.objects.exclude(photo='')
+                                          .values_list('photo', flat=True)))
+    chunks = [names[i:i + THUMBNAIL_CHUNK_SIZE]
+              for i in xrange(0, len(names), THUMBNAIL_CHUNK_SIZE)]
+    thumbnails.generate_all([thumbnails.StoredFile(default_storage, name)
+                             for name in DEFAULT_THUMBNAIL_SOURCES])
 
-    ids = (UserProfile.objects.values_list('id', flat=True))
-    ts = [tasks.index_objects.subtask(args=[UserProfile, chunk])
-          for chunk in chunked(sorted(list(ids)), 150)]
-    TaskSet(ts).apply_async()
+    # The forked workers must open their own connections.
+    connection.close()
+    cache.close()
+    pool = multiprocessing.Pool(_processes(processes))
+    try:
+        count = sum(pool.map(_generate_thumbnails, chunks))
+    finally:
+        pool.close()
+        pool.join()
+    log.info('Thumbnails: generated for %d photos in %.2fs.' %
+             (count, time.time() - start))
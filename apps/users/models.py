@@ -1,3 +1,6 @@
+import hashlib
+import os
+import re
 import uuid
 from datetime import datetime
 
@@ -8,19 +11,112 @@ from django.db import models
 from django.db.models import signals as dbsignals
 from django.dispatch import receiver
 
-from elasticutils import S
 from elasticutils.models import SearchMixin
 from sorl.thumbnail import ImageField
-from PIL import Image, ImageOps
 from tower import ugettext as _, ugettext_lazy as _lazy
 
-from groups.models import Group, Skill
+from common import indexing, search, searchcache
+from groups.models import Group, Skill, change_member_counts
 from phonebook.models import get_random_string
 
 # This is because we are using MEDIA_ROOT wrong in 1.4
 from django.core.files.storage import FileSystemStorage
-fs = FileSystemStorage(location=settings.UPLOAD_ROOT,
-                       base_url='/media/uploads/')
+
+#: Photos and renditions named after their content, see :func:`photo_path`.
+CONTENT_NAME_RE = re.compile(
+    r'^photos/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{40}(_\d+)?(\.\w+)?$')
+
+
+class PhotoStorage(FileSystemStorage):
+    """
+    Keeps one file per content-addressed name.
+
+    A file that exists under such a name already has the same bytes, so it
+    is kept rather than stored again as ``<sha>_1.jpg``.  The file is
+    written to a temporary name and renamed into place, so identical
+    uploads saved at the same moment both end up with the one name.
+    """
+
+    def get_available_name(self, name):
+        if CONTENT_NAME_RE.match(name):
+            return name
+        return super(PhotoStorage, self).get_available_name(name)
+
+    def _save(self, name, content):
+        if not CONTENT_NAME_RE.match(name):
+            return super(PhotoStorage, self)._save(name, content)
+        if not self.exists(name):
+            tmp = super(PhotoStorage, self)._save(
+                '%s.%s.tmp' % (name, uuid.uuid4().hex), content)
+            os.rename(self.path(tmp), self.path(name))
+        return name
+
+
+fs = PhotoStorage(location=settings.UPLOAD_ROOT, base_url='/media/uploads/')
+
+DEFAULT_PHOTO_URL = '/media/img/unknown.png'
+
+#: Square renditions (in pixels) made of every uploaded photo, see
+#: :func:`users.tasks.process_photo`.  The first one is the default.
+PHOTO_SIZES = (300, 100, 50)
+
+#: Seconds before a new photo is processed, so the save has been committed.
+PHOTO_PROCESS_COUNTDOWN = 5
+
+# Document fields copied into the combined ``search_text`` field (together
+# with group names) and the edge-ngram ``search_prefix`` field.
+SEARCH_TEXT_FIELDS = ('first_name', 'last_name', 'display_name', 'username',
+                      'bio', 'website', 'email', 'ircname')
+SEARCH_PREFIX_FIELDS = ('first_name', 'last_name')
+
+
+def photo_path(digest, filename):
+    """
+    Where a photo with SHA-1 ``digest`` uploaded as ``filename`` is stored.
+
+    The first two pairs of hex digits make two levels of directories, so
+    no directory on the NetApp share grows beyond a few files per 65536
+    photos.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if not ext[1:].isalnum():
+        ext = ''
+    return 'photos/%s/%s/%s%s' % (digest[:2], digest[2:4], digest, ext)
+
+
+def photo_upload_to(instance, filename):
+    """
+    Store photos under the SHA-1 of their content (see :func:`check_photo`).
+
+    Such a name never gets different content, so the URLs of photos and
+    their renditions can be cached forever.
+    """
+    digest = getattr(instance, '_photo_digest', None) or uuid.uuid4().hex
+    return photo_path(digest, filename)
+
+
+def rendition_name(name, size):
+    """The name the ``size`` pixel rendition of photo ``name`` is saved as."""
+    return '%s_%d.jpg' % (os.path.splitext(name)[0], size)
+
+
+def _photo_url(name, processed, size=PHOTO_SIZES[0]):
+    """
+    The URL of the ``size`` rendition of the stored photo called ``name``.
+
+    Until the photo has been ``processed`` that is the uploaded file itself;
+    without a photo it is the default image.
+    """
+    if name and processed:
+        return fs.url(rendition_name(name, size))
+    if name:
+        return fs.url(name)
+    return DEFAULT_PHOTO_URL
+
+
+def _search_text(values, groups):
+    """The ``search_text`` of a document with ``values`` and ``groups``."""
+    return u' '.join([values[a] or u'' for a in SEARCH_TEXT_FIELDS] + groups)
 
 
 class UserProfile(SearchMixin, models.Model):
@@ -46,8 +142,12 @@ class UserProfile(SearchMixin, models.Model):
     skills = models.ManyToManyField('groups.Skill')
     bio = models.TextField(verbose_name=_lazy(u'Bio'), default='', blank=True)
     photo = ImageField(default='', blank=True, storage=fs,
-                       upload_to='userprofile')
-    display_name = models.CharField(max_length=255, default='', blank=True)
+                       upload_to=photo_upload_to)
+    # SHA-1 of the photo once its renditions have been made.
+    photo_hash = models.CharField(max_length=40, default='', blank=True,
+                                  editable=False)
+    display_name = models.CharField(max_length=255, default='', blank=True,
+                                    db_index=True)
     ircname = models.CharField(max_length=63,
                                verbose_name=_lazy(u'IRC Nickname'),
                                default='', blank=True)
@@ -90,26 +190,32 @@ class UserProfile(SearchMixin, models.Model):
         self.save()
 
     def set_membership(self, model, membership_list):
-        """ Alters membership to Groups and Skillz """
+        """
+        Alters membership to Groups and Skillz
+
+        Takes the same number of queries however many names are given:
+        names are resolved in bulk and only the difference to the current
+        memberships is written.
+        """
         if model is Group:
             m2mfield = self.groups
         elif model is Skill:
             m2mfield = self.skills
 
-        # Remove any non-system groups that weren't supplied in this list.
-        m2mfield.remove(*[g for g in m2mfield.all()
-                                if g.name not in membership_list
-                                and not getattr(g, 'system', False)])
-
-        # Add/create the rest of the groups
-        groups_to_add = []
-        for g in membership_list:
-            (group, created) = model.objects.get_or_create(name=g)
+        wanted = model.get_or_create_many(membership_list)
+        wanted_ids = set(g.id for g in wanted)
+        current = list(m2mfield.all())
+        current_ids = set(g.id for g in current)
 
-            if not getattr(g, 'system', False):
-                groups_to_add.append(group)
-
-        m2mfield.add(*groups_to_add)
+        # Remove any non-system groups that weren't supplied in this list.
+        to_remove = [g for g in current if g.id not in wanted_ids
+                     and not getattr(g, 'system', False)]
+        # Add the rest of the groups.
+        to_add = [g for g in wanted if g.id not in current_ids]
+        if to_remove:
+            m2mfield.remove(*to_remove)
+        if to_add:
+            m2mfield.add(*to_add)
 
     def is_complete(self):
         """
@@ -118,10 +224,20 @@ class UserProfile(SearchMixin, models.Model):
         """
         return self.display_name and self.display_name != ' '
 
-    def photo_url(self):
-        if self.photo:
-            return self.photo.url
-        return '/media/img/unknown.png'
+    def photo_url(self, size=PHOTO_SIZES[0]):
+        return _photo_url(self.photo.name, self.photo_hash, size)
+
+    def derived_files(self, field):
+        """
+        Names of the files made from the file in ``field``.
+
+        The photo's renditions aren't referenced by any field;
+        ``find_orphaned_files`` asks for them here.
+        """
+        if field == 'photo' and self.photo:
+            return [rendition_name(self.photo.name, size)
+                    for size in PHOTO_SIZES]
+        return []
 
     def vouch(self, vouched_by, system=True, commit=True):
         changed = system  # do we need to do a vouch?
@@ -149,33 +265,165 @@ class UserProfile(SearchMixin, models.Model):
                   [self.user.email])
 
     def fields(self):
-        attrs = ('id', 'is_confirmed', 'is_vouched', 'website',
-                 'bio', 'display_name', 'ircname')
-        d = dict((a, getattr(self, a)) for a in attrs)
-        # user data
-        attrs = ('username', 'first_name', 'last_name', 'email', 'last_login',
-                 'date_joined')
-        d.update(dict((a, getattr(self.user, a)) for a in attrs))
-        # Index group ids... for fun.
-        groups = list(self.groups.values_list('name', flat=True))
-        d.update(dict(groups=groups))
-        return d
+        return self.index_documents([self.id])[self.id]
+
+    @classmethod
+    def index_documents(cls, ids, fields=None):
+        """
+        Build the search index documents for the profiles in ``ids``.
+
+        Uses three queries no matter how many ids are given: one for the
+        profiles joined to their users and one each for the group and skill
+        memberships.  Returns a dict of documents keyed by profile id.
+
+        With ``fields`` (``groups`` and/or ``skills``) only those lists are
+        built, plus ``search_text`` when the groups are among them, which
+        takes one more query.  Every id in ``ids`` gets a partial document
+        then, whether or not the profile exists.
+        """
+        profile_attrs = ('id', 'is_confirmed', 'is_vouched', 'website',
+                         'bio', 'display_name', 'ircname')
+        user_attrs = ('username', 'first_name', 'last_name', 'email',
+                      'last_login', 'date_joined')
+
+        docs = {}
+        if fields is None:
+            lists = ('groups', 'skills')
+            columns = (profile_attrs + ('photo', 'photo_hash') +
+                       tuple('user__' + a for a in user_attrs))
+            attrs = profile_attrs + ('photo_url', 'photo_hash') + user_attrs
+            for row in cls.objects.filter(id__in=ids).values_list(*columns):
+                d = dict(zip(attrs, row))
+                # Search results are rendered from the document alone.
+                d.update(photo_url=_photo_url(d['photo_url'],
+                                              d.pop('photo_hash')),
+                         groups=[], skills=[])
+                docs[d['id']] = d
+        else:
+            lists = [f for f in ('groups', 'skills') if f in fields]
+            for id in ids:
+                docs[id] = dict((f, []) for f in lists)
+            if 'groups' in lists:
+                text = {}
+                columns = tuple(a if a in profile_attrs else 'user__' + a
+                                for a in SEARCH_TEXT_FIELDS)
+                for row in (cls.objects.filter(id__in=ids)
+                                       .values_list('id', *columns)):
+                    text[row[0]] = dict(zip(SEARCH_TEXT_FIELDS, row[1:]))
+
+        memberships = (
+            ('groups', cls.groups.through.objects
+                                         .filter(userprofile__in=docs.keys())
+                                         .values_list('userprofile',
+                                                      'group__name')),
+            ('skills', cls.skills.through.objects
+                                         .filter(userprofile__in=docs.keys())
+                                         .values_list('userprofile',
+                                                      'skill__name')))
+        for key, rows in memberships:
+            if key in lists:
+                for profile_id, name in rows:
+                    docs[profile_id][key].append(name)
+
+        if fields is not None:
+            if 'groups' in lists:
+                for id, values in text.iteritems():
+                    docs[id]['search_text'] = _search_text(values,
+                                                           docs[id]['groups'])
+            return docs
+
+        for d in docs.itervalues():
+            d['search_text'] = _search_text(d, d['groups'])
+            d['search_prefix'] = u' '.join(
+                [d[a] or u'' for a in SEARCH_PREFIX_FIELDS])
+        return docs
+
+    @classmethod
+    def get_mapping(cls):
+        """The ElasticSearch mapping for profile documents."""
+        return {
+            'properties': {
+                'search_text': {'type': 'string', 'analyzer': 'standard'},
+                'search_prefix': {'type': 'string',
+                                  'index_analyzer': 'edge_ngram',
+                                  'search_analyzer': 'standard'},
+                'is_vouched': {'type': 'boolean'},
+                'is_confirmed': {'type': 'boolean'},
+                'username': {'type': 'string', 'index': 'not_analyzed'},
+                'photo_url': {'type': 'string', 'index': 'no'},
+            }
+        }
 
     @classmethod
-    def search(cls, query, vouched=None):
-        """Sensible default search for UserProfiles."""
+    def search(cls, query, vouched=None, source_only=False):
+        """
+        Sensible default search for UserProfiles.
+
+        With ``source_only`` the results are :class:`ProfileHit` objects
+        built from the index documents instead of database rows, and pages
+        of them are cached briefly (see :mod:`common.searchcache`).
+        """
         query = query.lower().strip()
-        fields = ('first_name__text', 'last_name__text', 'display_name__text',
-                  'username__text', 'bio__text', 'website__text',
-                  'email__text', 'groups__text', 'first_name__startswith',
-                  'last_name__startswith', 'ircname')
-        q = dict((field, query) for field in fields)
-        s = S(cls).query(or_=q)
+        q = dict(search_text__text=query, search_prefix__text=query)
+        s = search.get_search(cls).query(or_=q)
         if vouched is not None:
             s = s.filter(is_vouched=vouched)
+        if source_only:
+            results = s.values_dict()
+            if not settings.ES_DISABLED:
+                results = searchcache.CachedSearch(results, cls,
+                                                   (query, vouched))
+            return search.HitList(results, ProfileHit)
         return s
 
 
+class ProfileHit(object):
+    """
+    A profile search result rendered from its index document.
+
+    Has just enough of :class:`UserProfile`'s interface for
+    ``phonebook/includes/search_result.html``.
+    """
+
+    class User(object):
+        def __init__(self, username):
+            self.username = username
+
+    def __init__(self, document):
+        document = dict(document)
+        self._photo_url = document.pop('photo_url', DEFAULT_PHOTO_URL)
+        self.__dict__.update(document)
+        self.user = self.User(document.get('username'))
+
+    def __unicode__(self):
+        return self.display_name
+
+    def photo_url(self):
+        return self._photo_url
+
+
+class SimilarProfiles(models.Model):
+    """
+    The vouched profiles with skills most like ``profile``'s, best first.
+
+    Computed offline by :mod:`users.similar` and stored as comma-separated
+    ids so a profile page needs a single primary key lookup.
+    """
+    profile = models.OneToOneField(UserProfile, primary_key=True,
+                                   related_name='similar')
+    profiles = models.TextField(default='', blank=True)
+    computed = models.DateTimeField(db_index=True, default=datetime.now)
+
+    class Meta:
+        db_table = 'profile_similar'
+
+    def similar_profiles(self):
+        ids = [int(i) for i in self.profiles.split(',') if i]
+        profiles = (UserProfile.objects.select_related('user')
+                                       .filter(is_vouched=True).in_bulk(ids))
+        return [profiles[i] for i in ids if i in profiles]
+
+
 @receiver(models.signals.post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     dn = '%s %s' % (instance.first_name, instance.last_name)
@@ -219,23 +467,124 @@ def add_to_staff_group(sender, instance, created, **kwargs):
             instance.groups.add(Group.objects.get(name='staff', system=True))
 
 
-@receiver(dbsignals.post_save, sender=UserProfile)
-def resize_photo(sender, instance, **kwargs):
-    if instance.photo:
-        path = str(instance.photo.path)
-        img = Image.open(path)
-        img = ImageOps.fit(img, (300, 300), Image.ANTIALIAS, 0, (0.5, 0.5))
-        img.save(path)
+@receiver(dbsignals.pre_save, sender=UserProfile)
+def check_photo(sender, instance, raw, using, **kwargs):
+    """
+    Name freshly uploaded photos after their SHA-1 and skip known ones.
 
+    Only a freshly uploaded file is read (never decoded); saves that don't
+    upload a photo cost nothing.  A picture that has been uploaded before,
+    by this or another profile, isn't stored again, and re-uploading the
+    current photo changes nothing.
+    """
+    if raw:
+        return
+    photo = instance.photo
+    if not photo:
+        instance.photo_hash = ''
+        return
+    if photo._committed:
+        return
+    sha = hashlib.sha1()
+    for chunk in photo.chunks():
+        sha.update(chunk)
+    instance._photo_digest = sha.hexdigest()
+    name = photo_upload_to(instance, photo.name)
+    if fs.exists(name):
+        instance.photo = name
+        if instance.photo_hash == instance._photo_digest:
+            return
+    instance.photo_hash = ''
+    instance._photo_changed = True
 
-@receiver(dbsignals.post_save, sender=User)
+
+@receiver(dbsignals.post_save, sender=UserProfile)
+def process_photo(sender, instance, **kwargs):
+    """Make the renditions of a new photo in the background."""
+    if instance.__dict__.pop('_photo_changed', False):
+        from users import tasks
+        tasks.process_photo.apply_async(
+            args=[instance.id, instance.photo.name],
+            countdown=PHOTO_PROCESS_COUNTDOWN)
+
+
+@receiver(dbsignals.m2m_changed, sender=UserProfile.groups.through)
+@receiver(dbsignals.m2m_changed, sender=UserProfile.skills.through)
+def update_member_counts(sender, instance, action, reverse, model, pk_set,
+                         **kw):
+    """Keep ``member_count`` of Groups and Skills in step with members."""
+    tag_model = instance.__class__ if reverse else model
+    if action == 'post_add':
+        # pk_set only holds the memberships that didn't exist yet.
+        ids = [instance.id] * len(pk_set) if reverse else pk_set
+        change_member_counts(tag_model, ids, 1)
+    elif action in ('pre_remove', 'pre_clear'):
+        # Count the memberships that are actually about to go.
+        tag = tag_model._meta.object_name.lower()
+        this, other = (tag, 'userprofile') if reverse else ('userprofile', tag)
+        rows = sender.objects.filter(**{this: instance})
+        if pk_set is not None:
+            rows = rows.filter(**{other + '__in': pk_set})
+        change_member_counts(tag_model, rows.values_list(tag, flat=True), -1)
+
+
+@receiver(dbsignals.pre_delete, sender=UserProfile)
+def remove_member_counts(sender, instance, **kw):
+    """Deleting a profile drops its memberships without m2m_changed."""
+    change_member_counts(Group, instance.groups.values_list('id', flat=True),
+                         -1)
+    change_member_counts(Skill, instance.skills.values_list('id', flat=True),
+                         -1)
+
+
+# Saving a User always re-saves its profile (see create_user_profile), so
+# the profile's post_save is enough to catch both.
 @receiver(dbsignals.post_save, sender=UserProfile)
 def update_search_index(sender, instance, **kw):
-    from elasticutils import tasks
-    tasks.index_objects.delay(UserProfile, [instance.id])
+    indexing.schedule_index(UserProfile, [instance.id])
+
+
+# Adding and removing groups or skills doesn't save the profile.
+@receiver(dbsignals.m2m_changed, sender=UserProfile.groups.through)
+def update_groups_in_search_index(sender, **kw):
+    indexing.schedule_m2m_update(UserProfile, 'groups', **kw)
+
+
+@receiver(dbsignals.m2m_changed, sender=UserProfile.skills.through)
+def update_skills_in_search_index(sender, **kw):
+    indexing.schedule_m2m_update(UserProfile, 'skills', **kw)
+
+
+@receiver(dbsignals.m2m_changed, sender=UserProfile.skills.through)
+def touch_skill_owners(sender, instance, action, reverse, pk_set, **kw):
+    """
+    Stamp ``last_updated`` of the profiles whose skills changed.
+
+    The incremental similar profiles run (``users.similar``) looks for
+    changed profiles by ``last_updated``, which only a save would set.
+    """
+    if reverse and action == 'pre_clear':
+        rows = sender.objects.filter(skill=instance)
+        instance._skill_owners = list(rows.values_list('userprofile',
+                                                       flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        ids = [instance.id]
+    elif action == 'post_clear':
+        ids = instance.__dict__.pop('_skill_owners', [])
+    else:
+        ids = pk_set
+    if ids:
+        (UserProfile.objects.filter(id__in=ids)
+                            .update(last_updated=datetime.now()))
 
 
 @receiver(dbsignals.post_delete, sender=UserProfile)
 def remove_from_search_index(sender, instance, **kw):
-    from elasticutils import tasks
+    from common import tasks
+    indexing.coalescer.discard(UserProfile, [instance.id])
     tasks.unindex_objects.delay(sender, [instance.id])
+    if settings.ES_DISABLED:
+        search.unindex_objects(UserProfile, [instance.id])
@@ -0,0 +1,199 @@
+"""
+"People with similar skills" recommendations.
+
+Every vouched profile with skills gets a vector over all skills weighted by
+TF-IDF.  A profile has each skill once, so the term frequency is 1 and the
+weight is the skill's smoothed inverse document frequency: a rare skill
+says more about somebody than one half the directory lists.  Rows are
+L2-normalised, so the cosine similarity of every pair of profiles is
+``X * X.T``.
+
+That product is never built whole.  It is computed :data:`BLOCK_SIZE` rows at
+a time in a pool of worker processes, and each block only keeps the
+:data:`TOP_N` most similar other profiles of each of its rows.  The results
+are stored in :class:`users.models.SimilarProfiles`.
+
+:func:`update` recomputes every profile.  With ``incremental`` it recomputes
+only the profiles changed (``last_updated``, which adding or removing skills
+sets too) since the previous run started; their neighbours' lists catch up
+with the next full run.  The start of the last run is kept in the cache.
+
+Needs NumPy and SciPy (see ``requirements/compiled.txt``).
+"""
+import multiprocessing
+import time
+from datetime import datetime
+from itertools import chain
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+
+import numpy as np
+from scipy import sparse
+
+from users.models import SimilarProfiles, UserProfile
+
+TOP_N = 10
+BLOCK_SIZE = 256
+BULK_CHUNK_SIZE = 500
+
+LAST_RUN_KEY = 'similar:last-run'
+LAST_RUN_TIMEOUT = 60 * 60 * 24 * 30
+
+# The matrix the worker processes multiply with; see _init_worker.
+_matrix = None
+
+
+def load_skills():
+    """Return the ``(profile id, skill id)`` rows of vouched profiles."""
+    rows = (UserProfile.skills.through.objects
+                       .filter(userprofile__is_vouched=True)
+                       .values_list('userprofile', 'skill'))
+    pairs = np.fromiter(chain.from_iterable(rows.iterator()), dtype=np.int64)
+    return pairs.reshape(-1, 2)
+
+
+def tfidf_matrix(pairs):
+    """
+    Build the row-normalised profiles x skills TF-IDF matrix of ``pairs``.
+
+    Returns the matrix and the profile id of each row.
+    """
+    profiles, rows = np.unique(pairs[:, 0], return_inverse=True)
+    skills, cols = np.unique(pairs[:, 1], return_inverse=True)
+    idf = np.log((1.0 + len(profiles)) / (1.0 + np.bincount(cols))) + 1
+    matrix = sparse.csr_matrix((idf[cols], (rows, cols)),
+                               shape=(len(profiles), len(skills)))
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+    return matrix, profiles
+
+
+def _init_worker(matrix):
+    global _matrix
+    _matrix = matrix
+
+
+def _nearest(rows, n=TOP_N):
+    """Return ``(row, [most similar rows])`` for each of ``rows``."""
+    scores = _matrix[rows].dot(_matrix.T).tocsr()
+    result = []
+    for i, row in enumerate(rows):
+        start, end = scores.indptr[i], scores.indptr[i + 1]
+        cols, data = scores.indices[start:end], scores.data[start:end]
+        other = cols != row
+        cols, data = cols[other], data[other]
+        if len(data) > n:
+            best = np.argpartition(-data, n)[:n]
+            cols, data = cols[best], data[best]
+        result.append((row, cols[np.lexsort((cols, -data))]))
+    return result
+
+
+def nearest(matrix, rows, processes=None):
+    """
+    Return ``{row: [most similar rows]}`` for ``rows`` of ``matrix``.
+
+    Blocks of rows are handed to ``processes`` workers (all CPUs by
+    default); with ``processes=1`` everything runs in this process.
+    """
+    blocks = [rows[i:i + BLOCK_SIZE] for i in xrange(0, len(rows),
+                                                      BLOCK_SIZE)]
+    if not blocks:
+        return {}
+    if processes == 1:
+        _init_worker(matrix)
+        results = map(_nearest, blocks)
+    else:
+        # Workers are forked, so they inherit the matrix without pickling.
+        pool = multiprocessing.Pool(processes, _init_worker, (matrix,))
+        try:
+            results = pool.map(_nearest, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    return dict(chain.from_iterable(results))
+
+
+@transaction.commit_on_success
+def _store(similar, computed, replace=None):
+    """
+    Save ``similar`` (``{profile id: [profile ids]}``).
+
+    Deletes the rows of the profile ids in ``replace`` first, or every row
+    if it is None.
+    """
+    if replace is None:
+        SimilarProfiles.objects.all().delete()
+    else:
+        replace = list(replace)
+        for i in xrange(0, len(replace), BULK_CHUNK_SIZE):
+            chunk = replace[i:i + BULK_CHUNK_SIZE]
+            SimilarProfiles.objects.filter(profile__in=chunk).delete()
+    rows = [SimilarProfiles(profile_id=id, profiles=','.join(map(str, ids)),
+                            computed=computed)
+            for id, ids in similar.iteritems() if ids]
+    for i in xrange(0, len(rows), BULK_CHUNK_SIZE):
+        SimilarProfiles.objects.bulk_create(rows[i:i + BULK_CHUNK_SIZE])
+    return len(rows)
+
+
+def update(incremental=False, processes=None):
+    """
+    Recompute the similar profiles; returns how many profiles were stored.
+
+    The first incremental run, with no previous run to go by, is a full one.
+    """
+    started = datetime.now()
+    changed = None
+    if incremental:
+        since = cache.get(LAST_RUN_KEY)
+        if since is None:
+            # An evicted key; the newest stored row is the next best guess.
+            since = (SimilarProfiles.objects.aggregate(Max('computed'))
+                                            ['computed__max'])
+        if since:
+            changed = set(UserProfile.objects
+                          .filter(last_updated__gte=since)
+                          .values_list('id', flat=True))
+
+    pairs = load_skills()
+    similar = {}
+    if len(pairs):
+        matrix, ids = tfidf_matrix(pairs)
+        rows = np.arange(len(ids))
+        if changed is not None:
+            rows = rows[np.in1d(ids, list(changed))]
+        for row, neighbours in nearest(matrix, rows, processes).iteritems():
+            similar[int(ids[row])] = [int(ids[c]) for c in neighbours]
+    count = _store(similar, started, changed)
+    # Even a run that stored nothing moves the next one's window on.
+    cache.set(LAST_RUN_KEY, started, LAST_RUN_TIMEOUT)
+    return count
+
+
+def benchmark(profiles=100000, skills=5000, seed=1, processes=None):
+    """
+    Time :func:`nearest` over a synthetic directory of ``profiles``.
+
+    Each profile gets 1 + Poisson(4) skills drawn from a Zipf distribution
+    over ``skills`` skills.  Nothing touches the database.
+    """
+    rng = np.random.RandomState(seed)
+    counts = 1 + rng.poisson(4, profiles)
+    owners = np.repeat(np.arange(profiles), counts)
+    picks = np.minimum(rng.zipf(1.3, len(owners)), skills) - 1
+    pairs = np.unique(owners * skills + picks)
+    pairs = np.column_stack((pairs // skills, pairs % skills))
+
+    report = {'profiles': profiles, 'skills': skills, 'seed': seed,
+              'pairs': len(pairs), 'block_size': BLOCK_SIZE,
+              'processes': processes or multiprocessing.cpu_count()}
+    start = time.time()
+    matrix, ids = tfidf_matrix(pairs)
+    report['tfidf_seconds'] = round(time.time() - start, 2)
+    start = time.time()
+    nearest(matrix, np.arange(len(ids)), processes)
+    report['nearest_seconds'] = round(time.time() - start, 2)
+    return report
@@ -0,0 +1,73 @@
+import hashlib
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+import commonware.log
+from celery.task import task
+from PIL import Image, ImageOps
+
+from common import indexing, thumbnails
+
+log = commonware.log.getLogger('m.tasks')
+
+
+def make_renditions(data, sizes):
+    """
+    Return ``{size: JPEG data}`` with a square crop of image ``data``.
+
+    The image is decoded once; every rendition is scaled down from the
+    previous, larger one.  Raises IOError for images with more than
+    ``settings.MAX_PHOTO_PIXELS`` pixels.
+    """
+    img = Image.open(StringIO(data))
+    # Opening only reads the header; refuse decompression bombs before
+    # anything is decoded.
+    width, height = img.size
+    if width * height > settings.MAX_PHOTO_PIXELS:
+        raise IOError('%dx%d pixels is too many' % (width, height))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    renditions = {}
+    for size in sorted(sizes, reverse=True):
+        img = ImageOps.fit(img, (size, size), Image.ANTIALIAS, 0, (0.5, 0.5))
+        out = StringIO()
+        img.save(out, 'JPEG', quality=90)
+        renditions[size] = out.getvalue()
+    return renditions
+
+
+@task
+def process_photo(profile_id, name, **kw):
+    """
+    Save the renditions of ``name``, the photo of profile ``profile_id``.
+
+    Photos are named after their content, so renditions that already exist
+    (of a picture somebody else uploaded too) are kept as they are.  Also
+    generates the thumbnails templates use.  Records the photo's hash on the
+    profile and reindexes it, unless the photo has been replaced in the
+    meantime.
+    """
+    from users.models import PHOTO_SIZES, UserProfile, fs, rendition_name
+
+    missing = [size for size in PHOTO_SIZES
+               if not fs.exists(rendition_name(name, size))]
+    try:
+        f = fs.open(name)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        renditions = make_renditions(data, missing) if missing else {}
+    except (IOError, OSError) as e:
+        log.warning('Could not process photo %s: %s' % (name, e))
+        return
+    for size, content in renditions.iteritems():
+        fs.save(rendition_name(name, size), ContentFile(content))
+    thumbnails.generate_all([thumbnails.StoredFile(fs, name)])
+
+    digest = hashlib.sha1(data).hexdigest()
+    if (UserProfile.objects.filter(id=profile_id, photo=name)
+                           .update(photo_hash=digest)):
+        indexing.schedule_index(UserProfile, [profile_id])
@@ -1,14 +1,31 @@
+import hashlib
+import os
+import sys
+from cStringIO import StringIO
+from datetime import datetime, timedelta
+
 from django.contrib.auth.models import User
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
 
+from elasticutils import get_es
 from funfactory.urlresolvers import reverse
 from nose.tools import eq_
+from PIL import Image
 from pyquery import PyQuery as pq
 
-from common import browserid_mock
+from common import (browserid_mock, indexing, pagination, search,
+                    thumbnails)
+from common.cron import find_orphaned_files
+from common.helpers import thumbnail
 from common.tests import ESTestCase, TestCase
-from groups.models import Group
-from users.models import UserProfile
+from groups.models import Group, Skill
+from users.cron import _copy_photo, migrate_photos, sweep_legacy_photos
+from users.models import (PHOTO_SIZES, SimilarProfiles, UserProfile, fs,
+                          photo_path, rendition_name)
 
 Group.objects.get_or_create(name='staff', system=True)
 
@@ -333,6 +350,33 @@ class VouchTest(ESTestCase):
                 'User should appear as a Mozillian in search.')
 
 
+class TestReindex(ESTestCase):
+
+    def setUp(self):
+        super(TestReindex, self).setUp()
+        self.es = get_es()
+        self.alias = indexing.index_name(UserProfile)
+
+    def tearDown(self):
+        # Leave the plain index ESTestCase expects behind.
+        for index in self.es.get_indices():
+            if index.startswith(self.alias + '_'):
+                self.es.delete_index(index)
+        indexing.create_index(self.alias, [UserProfile])
+        super(TestReindex, self).tearDown()
+
+    def test_first_run_replaces_plain_index(self):
+        assert self.alias in self.es.get_indices()
+        new, reports = indexing.reindex([UserProfile])
+        eq_(self.es.get_alias(self.alias), [new])
+        eq_(UserProfile.search(self.mozillian.email).count(), 1)
+
+    def test_first_run_on_fresh_cluster(self):
+        self.es.delete_index(self.alias)
+        new, reports = indexing.reindex([UserProfile])
+        eq_(self.es.get_alias(self.alias), [new])
+
+
 class TestUser(TestCase):
     """Test User functionality"""
 
@@ -354,6 +398,54 @@ class TestUser(TestCase):
         assert u.get_profile()
 
 
+class TestSetMembership(TestCase):
+
+    def membership_queries(self, profile, names):
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            before = len(connection.queries)
+            profile.set_membership(Skill, names)
+            return len(connection.queries) - before
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+
+    def test_query_count_is_constant(self):
+        profile = self.mozillian.get_profile()
+        few = self.membership_queries(self.pending.get_profile(),
+                                      ['Few %d' % i for i in range(3)])
+        many = self.membership_queries(profile,
+                                       ['many %d' % i for i in range(30)])
+        eq_(few, many)
+        eq_(sorted(profile.skills.values_list('name', flat=True)),
+            sorted('many %d' % i for i in range(30)))
+        eq_(Skill.objects.get(name='many 7').member_count, 1)
+
+        # Replacing a few of them costs the same as replacing many.
+        few = self.membership_queries(profile, ['many %d' % i
+                                                for i in range(27)] +
+                                               ['more %d' % i
+                                                for i in range(3)])
+        many = self.membership_queries(profile, ['other %d' % i
+                                                 for i in range(30)])
+        eq_(few, many)
+        eq_(Skill.objects.get(name='many 7').member_count, 0)
+
+    def test_system_groups(self):
+        profile = self.mozillian.get_profile()
+        crew = Group.objects.create(name='crew', system=True)
+        ghost = Group.objects.create(name='ghost', system=True)
+        profile.groups.add(crew)
+
+        # System groups that aren't listed are kept; listed ones are added
+        # like any other group.
+        profile.set_membership(Group, ['ghost', 'New Group'])
+        eq_(sorted(profile.groups.values_list('name', flat=True)),
+            ['crew', 'ghost', 'new group'])
+        eq_(list(ghost.userprofile_set.all()), [profile])
+        eq_(Group.objects.get(name='new group').url, 'new-group')
+
+
 class TestMigrateRegistration(TestCase):
         """Test funky behavior of flee ldap"""
         email = 'robot1337@domain.com'
@@ -414,8 +506,425 @@ class TestDeleteUser(TestCase):
                             'date_joined',
                             'id',
                             'ircname',
-                            'is_vouched']
+                            'is_vouched',
+                            'skills',
+                            'photo_url',
+                            'search_text',
+                            'search_prefix']
 
         if self.mozillian.get_profile().fields().keys().sort() != accounted_fields.sort():
             raise Exception('Field in UserProfile clean method not accounted'
                             ' for.')
+
+
+class TestLocalSearch(TestCase):
+    """Test the in-process index UserProfile.search uses without ES."""
+
+    def setUp(self):
+        super(TestLocalSearch, self).setUp()
+        self._es_disabled = settings.ES_DISABLED
+        settings.ES_DISABLED = True
+        search.reset_index()
+
+    def tearDown(self):
+        settings.ES_DISABLED = self._es_disabled
+        search.reset_index()
+        super(TestLocalSearch, self).tearDown()
+
+    def test_prefix_and_vouched_filter(self):
+        results = UserProfile.search('Am')
+        assert isinstance(results, search.LocalS)
+        names = [p.display_name for p in results]
+        assert 'Amandeep McIlrath' in names
+        assert 'Amanda Younger' in names
+
+        names = [p.display_name for p in UserProfile.search('Am',
+                                                            vouched=False)]
+        eq_(names, ['Amanda Younger'])
+
+    def test_combined_fields(self):
+        u = User.objects.create(email='ford@betelgeuse.org', username='fp',
+                                first_name='Ford', last_name='Prefect')
+        u.get_profile().groups.add(Group.objects.create(name='hitchhikers'))
+        u.get_profile().save()
+
+        for query in ('betelgeuse', 'hitchhikers', 'pref', 'Ford Prefect'):
+            eq_([p.user for p in UserProfile.search(query)], [u])
+
+    def test_source_only_results(self):
+        photo_url = self.mozillian.get_profile().photo_url()
+        results = UserProfile.search('Amandeep', source_only=True)
+        eq_(results.count(), 1)
+
+        with self.assertNumQueries(0):
+            hit = results[0]
+        eq_(hit.display_name, 'Amandeep McIlrath')
+        eq_(hit.user.username, self.mozillian.username)
+        eq_(hit.photo_url(), photo_url)
+        assert hit.is_vouched
+
+    def test_search_paginator_counts_from_the_page(self):
+        results = UserProfile.search('Am', source_only=True)
+        calls = []
+        fetch = results.search.page
+
+        def page(start, stop):
+            calls.append((start, stop))
+            return fetch(start, stop)
+        results.search.page = page
+
+        paginator = pagination.SearchPaginator(results, 1)
+        people = paginator.page(2)
+        eq_(paginator.count, 2)
+        eq_(len(people.object_list), 1)
+        assert people.has_previous() and not people.has_next()
+        eq_(calls, [(1, 2)])
+
+    def test_index_follows_saves_and_deletes(self):
+        eq_(UserProfile.search('Zaphod').count(), 0)
+
+        u = User.objects.create(email='zaphod@example.com', username='zb',
+                                first_name='Zaphod', last_name='Beeblebrox')
+        eq_(UserProfile.search('zaph').count(), 1)
+        eq_(UserProfile.search('beeblebrox')[0].user, u)
+
+        u.get_profile().delete()
+        eq_(UserProfile.search('Zaphod').count(), 0)
+
+    def test_index_follows_membership_changes(self):
+        u = User.objects.create(email='arthur@example.com', username='ad',
+                                first_name='Arthur', last_name='Dent')
+        profile = u.get_profile()
+        group = Group.objects.create(name='heartofgold')
+        eq_(UserProfile.search('heartofgold').count(), 0)
+
+        profile.groups.add(group)
+        eq_([p.user for p in UserProfile.search('heartofgold')], [u])
+        eq_([p.user for p in UserProfile.search('dent')], [u])
+        profile.groups.remove(group)
+        eq_(UserProfile.search('heartofgold').count(), 0)
+
+        group.userprofile_set.add(profile)
+        eq_(UserProfile.search('heartofgold').count(), 1)
+        group.userprofile_set.clear()
+        eq_(UserProfile.search('heartofgold').count(), 0)
+
+        profile.skills.add(Skill.objects.create(name='towels'))
+        document = search.get_index(UserProfile).document(profile.id)
+        eq_(document['skills'], ['towels'])
+
+
+class TestBulkIndexing(TestCase):
+
+    def test_stream_ids(self):
+        for i in range(5):
+            User.objects.create(email='bulk%d@example.com' % i,
+                                username='bulk%d' % i)
+        expected = list(UserProfile.objects.order_by('id')
+                                           .values_list('id', flat=True))
+        eq_(list(indexing.stream_ids(UserProfile, chunk_size=2)), expected)
+
+    def test_adaptive_batch_size(self):
+        batch = indexing.AdaptiveBatchSize(size=100, target=1.0,
+                                           minimum=10, maximum=120)
+        eq_(batch.record(0.1), 120)
+        eq_(batch.record(2.0), 60)
+        eq_(batch.record(0.7), 60)
+        for i in range(5):
+            batch.record(5.0)
+        eq_(int(batch), 10)
+
+
+class TestIndexDocuments(TestCase):
+
+    def test_batch_matches_single_document(self):
+        profiles = []
+        for i in range(3):
+            u = User.objects.create(email='doc%d@example.com' % i,
+                                    username='doc%d' % i,
+                                    first_name='Doc', last_name=str(i))
+            p = u.get_profile()
+            p.groups.add(Group.objects.create(name='docs group %d' % i))
+            p.skills.add(Skill.objects.create(name='docs skill %d' % i))
+            profiles.append(p)
+
+        ids = [p.id for p in profiles]
+        with self.assertNumQueries(3):
+            docs = UserProfile.index_documents(ids)
+
+        eq_(sorted(docs), sorted(ids))
+        for i, p in enumerate(profiles):
+            eq_(docs[p.id]['username'], 'doc%d' % i)
+            eq_(docs[p.id]['groups'], ['docs group %d' % i])
+            eq_(docs[p.id]['skills'], ['docs skill %d' % i])
+            eq_(docs[p.id], p.fields())
+
+    def test_partial_documents(self):
+        u = User.objects.create(email='part@example.com', username='part',
+                                first_name='Part', last_name='Doc')
+        p = u.get_profile()
+        p.groups.add(Group.objects.create(name='partial group'))
+        p.skills.add(Skill.objects.create(name='partial skill'))
+        full = p.fields()
+
+        with self.assertNumQueries(1):
+            docs = UserProfile.index_documents([p.id], ['skills'])
+        eq_(docs, {p.id: {'skills': ['partial skill']}})
+
+        with self.assertNumQueries(2):
+            docs = UserProfile.index_documents([p.id], ['groups'])
+        eq_(docs, {p.id: {'groups': ['partial group'],
+                          'search_text': full['search_text']}})
+
+
+class TestIndexCoalescing(TestCase):
+
+    def test_saves_are_coalesced(self):
+        profile = self.mozillian.get_profile()
+        with indexing.coalesced() as coalescer:
+            profile.save()
+            self.mozillian.save()
+            profile.save()
+            eq_(coalescer.pending, {UserProfile: set([profile.id])})
+            eq_(coalescer.scheduled, 3)
+            eq_(coalescer.duplicates, 2)
+        eq_(indexing.coalescer.pending, {})
+
+    def test_deleted_profiles_are_not_indexed(self):
+        u = User.objects.create(email='gone@example.com', username='gone')
+        with indexing.coalesced() as coalescer:
+            profile = u.get_profile()
+            profile.save()
+            profile.delete()
+            eq_(coalescer.pending[UserProfile], set())
+
+    def test_membership_changes_only_update_their_field(self):
+        profile = self.mozillian.get_profile()
+        skill = Skill.objects.create(name='coalesced skill')
+        with indexing.coalesced() as coalescer:
+            profile.skills.add(skill)
+            profile.groups.add(Group.objects.create(name='coalesced group'))
+            eq_(coalescer.partial,
+                {UserProfile: {profile.id: set(['groups', 'skills'])}})
+            assert UserProfile not in coalescer.pending
+
+    def test_reverse_membership_changes(self):
+        profile = self.mozillian.get_profile()
+        group = Group.objects.create(name='reverse group')
+        group.userprofile_set.add(profile)
+        with indexing.coalesced() as coalescer:
+            group.userprofile_set.clear()
+            eq_(coalescer.partial,
+                {UserProfile: {profile.id: set(['groups'])}})
+
+
+class TestSimilarProfiles(TestCase):
+
+    def setUp(self):
+        super(TestSimilarProfiles, self).setUp()
+        python, rust, css = [Skill.objects.create(name=n)
+                             for n in ('python', 'rust', 'css')]
+        self.profiles = []
+        for i, skills in enumerate([(python, rust), (python, rust),
+                                    (python, css), (css,)]):
+            u = User.objects.create(email='similar%d@example.com' % i,
+                                    username='similar%d' % i)
+            profile = u.get_profile()
+            profile.skills.add(*skills)
+            profile.vouch(None)
+            self.profiles.append(profile)
+
+    def test_similar_profiles(self):
+        from users import similar
+
+        similar.update(processes=1)
+        a, b, c, d = self.profiles
+        r = self.mozillian_client.get(reverse('profile',
+                                              args=[a.user.username]))
+        eq_(r.context['similar_profiles'], [b, c])
+
+        # Only profiles changed since the last run are recomputed; adding a
+        # skill counts without a save.
+        last_run = datetime(2012, 1, 1)
+        cache.set(similar.LAST_RUN_KEY, last_run)
+        SimilarProfiles.objects.update(computed=last_run)
+        UserProfile.objects.update(last_updated=last_run - timedelta(1))
+        d.skills.add(Skill.objects.get(name='python'))
+        eq_(similar.update(incremental=True, processes=1), 1)
+        eq_(SimilarProfiles.objects.get(pk=b.pk).computed, last_run)
+        eq_(SimilarProfiles.objects.get(pk=d.pk).similar_profiles(), [c, a, b])
+
+        # A run that stores nothing still moves the window on.
+        eq_(similar.update(incremental=True, processes=1), 0)
+        assert cache.get(similar.LAST_RUN_KEY) > last_run
+
+
+def _jpeg(size=(400, 300), color='red'):
+    out = StringIO()
+    Image.new('RGB', size, color).save(out, 'JPEG')
+    return out.getvalue()
+
+
+class TestPhotos(TestCase):
+
+    def setUp(self):
+        super(TestPhotos, self).setUp()
+        self.profile = self.mozillian.get_profile()
+
+    def upload(self, data):
+        self.profile.photo = SimpleUploadedFile('photo.jpg', data)
+        self.profile.save()
+        self.profile = UserProfile.objects.get(pk=self.profile.pk)
+
+    def test_renditions(self):
+        data = _jpeg()
+        self.upload(data)
+        name = self.profile.photo.name
+        digest = hashlib.sha1(data).hexdigest()
+        eq_(name, 'photos/%s/%s/%s.jpg' % (digest[:2], digest[2:4], digest))
+        eq_(self.profile.photo_hash, digest)
+        for size in PHOTO_SIZES:
+            rendition = Image.open(fs.path(rendition_name(name, size)))
+            eq_(rendition.size, (size, size))
+        eq_(self.profile.photo_url(),
+            fs.url(rendition_name(name, PHOTO_SIZES[0])))
+        eq_(self.profile.fields()['photo_url'], self.profile.photo_url())
+
+    def test_renditions_are_not_orphans(self):
+        self.upload(_jpeg(color='green'))
+        name = self.profile.photo.name
+        out = StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            with self.settings(MEDIA_ROOT=fs.location):
+                find_orphaned_files(os.path.dirname(name))
+        finally:
+            sys.stdout = stdout
+        eq_(out.getvalue(), '')
+
+    def test_unchanged_photo_is_not_processed(self):
+        data = _jpeg(color='blue')
+        self.upload(data)
+        name = self.profile.photo.name
+        small = rendition_name(name, PHOTO_SIZES[-1])
+        fs.delete(small)
+
+        self.profile.display_name = 'Someone Else'
+        self.profile.save()
+        assert not fs.exists(small)
+
+        self.upload(data)
+        eq_(self.profile.photo.name, name)
+        assert not fs.exists(small)
+
+    def test_duplicate_uploads_are_stored_once(self):
+        data = _jpeg(color='yellow')
+        self.upload(data)
+        other = self.pending.get_profile()
+        other.photo = SimpleUploadedFile('copy.jpg', data)
+        other.save()
+        other = UserProfile.objects.get(pk=other.pk)
+        eq_(other.photo.name, self.profile.photo.name)
+        eq_(other.photo_url(), self.profile.photo_url())
+        assert not fs.exists(self.profile.photo.name.replace('.jpg',
+                                                             '_1.jpg'))
+
+    def test_simultaneous_uploads_share_a_name(self):
+        data = _jpeg(color='white')
+        name = photo_path(hashlib.sha1(data).hexdigest(), 'photo.jpg')
+        # Both requests found no stored file, so both save one.
+        eq_(fs.save(name, ContentFile(data)), name)
+        eq_(fs.save(name, ContentFile(data)), name)
+        assert not fs.exists(name.replace('.jpg', '_1.jpg'))
+        eq_([f for f in fs.listdir(os.path.dirname(name))[1]
+             if f.startswith(os.path.basename(name))],
+            [os.path.basename(name)])
+
+    def test_removing_photo(self):
+        self.upload(_jpeg(color='green'))
+        self.profile.photo = ''
+        self.profile.save()
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        eq_(profile.photo_hash, '')
+        eq_(profile.photo_url(), '/media/img/unknown.png')
+
+    def test_migrate_photos(self):
+        data = _jpeg(color='purple')
+        old = fs.save('userprofile/legacy.jpg', ContentFile(data))
+        UserProfile.objects.filter(pk=self.profile.pk).update(photo=old)
+
+        migrate_photos(per_second='1000')
+        migrate_photos(per_second='1000')
+        profile = UserProfile.objects.get(pk=self.profile.pk)
+        eq_(profile.photo.name,
+            photo_path(hashlib.sha1(data).hexdigest(), 'legacy.jpg'))
+        assert fs.exists(profile.photo.name)
+        # The old file stays until it is swept.
+        assert fs.exists(old)
+        sweep_legacy_photos()
+        assert not fs.exists(old)
+        assert fs.exists(profile.photo.name)
+
+    def test_migrate_photos_after_interruption(self):
+        data = _jpeg(color='navy')
+        old = fs.save('userprofile/interrupted.jpg', ContentFile(data))
+        UserProfile.objects.filter(pk=self.profile.pk).update(photo=old)
+        new = photo_path(hashlib.sha1(data).hexdigest(), old)
+
+        # A run stopped after copying the file, before the profile changed.
+        _copy_photo(old, new)
+        migrate_photos(per_second='1000')
+        eq_(UserProfile.objects.get(pk=self.profile.pk).photo.name, new)
+
+        # A form loaded before the move writes the old name back.
+        UserProfile.objects.filter(pk=self.profile.pk).update(photo=old)
+        sweep_legacy_photos()
+        assert fs.exists(old)
+        migrate_photos(per_second='1000')
+        eq_(UserProfile.objects.get(pk=self.profile.pk).photo.name, new)
+        sweep_legacy_photos()
+        assert not fs.exists(old)
+        assert fs.exists(new)
+
+    def test_thumbnails_are_pregenerated(self):
+        self.upload(_jpeg(color='orange'))
+        source = thumbnails.StoredFile(fs, self.profile.photo.name)
+        url = thumbnails.lookup(source, '100x100')
+        assert url
+        eq_(thumbnail(self.profile.photo, '100x100').url, url)
+
+    def test_thumbnail_miss_returns_original(self):
+        source = thumbnails.source_file('img/unknown.png')
+        cache.delete(thumbnails._key(source, '7x7', {}))
+        thumbnails._urls.clear()
+        eq_(thumbnail(None, '7x7', default='img/unknown.png').url,
+            '/media/img/unknown.png')
+
+    def test_thumbnail_miss_without_broker(self):
+        from common import tasks
+
+        def delay(*args, **kw):
+            raise IOError('Connection refused')
+        source = thumbnails.source_file('img/unknown.png')
+        key = thumbnails._key(source, '9x9', {})
+        cache.delete(key)
+        cache.delete(key + ':pending')
+        thumbnails._urls.clear()
+        original, tasks.generate_thumbnails.delay = (
+            tasks.generate_thumbnails.delay, delay)
+        try:
+            eq_(thumbnail(None, '9x9', default='img/unknown.png').url,
+                '/media/img/unknown.png')
+        finally:
+            tasks.generate_thumbnails.delay = original
+
+    def test_thumbnails_of_huge_images_are_skipped(self):
+        name = fs.save('thumbnail-tests/huge.jpg', ContentFile(_jpeg()))
+        source = thumbnails.StoredFile(fs, name)
+        cache.delete(thumbnails._key(source, '100x100', {}))
+        thumbnails._urls.clear()
+        with self.settings(MAX_PHOTO_PIXELS=1000):
+            thumbnails.generate_all([source])
+        eq_(thumbnails.lookup(source, '100x100'), None)
+        thumbnails.generate_all([source])
+        assert thumbnails.lookup(source, '100x100')
@@ -4,13 +4,18 @@
         var paginator = $('.pagination');
         var results = $('#final-result')
         var pages = paginator.attr('data-pages');
+        // Opaque cursor for the page after the last one we've shown.
+        var cursor = paginator.attr('data-cursor');
         // Variable to keep track of whether we've reached our max page
         var cease;
+        // Whether a page is being fetched; the cursor only moves on once
+        // it has arrived.
+        var loading = false;
         paginator.hide();
         results.hide();
 
         // If there is no paginator, don't do any scrolling
-        cease =  (pages == undefined)
+        cease =  (pages == undefined || !cursor)
 
         $(document).endlessScroll({
             // Number of pixels from the bottom at which callback is triggered
@@ -22,16 +27,27 @@
                 return cease;
             },
             callback: function(i) {
-                cease = (pages < i);
+                if (loading) {
+                    return;
+                }
+                cease = !cursor;
                 if (cease) {
                     // Show the user that we have stopped scrolling on purpose.
                     results.show()
                 } else {
+                    loading = true;
                     $.ajax({
-                        data:{'page': i + 1},
+                        data:{'cursor': cursor},
                         dataType: 'html',
                         success: function(data) {
-                            paginator.before($(data));
+                            var page = $('<div>').html(data);
+                            var next = page.find('.next-cursor');
+                            cursor = next.attr('data-cursor');
+                            next.remove();
+                            paginator.before(page.children());
+                        },
+                        complete: function() {
+                            loading = false;
                         }
                     });
                 }
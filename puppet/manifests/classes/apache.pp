@@ -28,10 +28,16 @@ class apache {
                 ensure => present,
                 before => File['/etc/apache2/sites-enabled/playdoh-site.conf']; 
             }
+            # playdoh-site.conf sets Cache-Control headers.
+            exec { "a2enmod_headers":
+                command => "/usr/sbin/a2enmod headers",
+                creates => "/etc/apache2/mods-enabled/headers.load",
+                require => [ Package['apache2-dev'] ];
+            }
             file { "/etc/apache2/sites-enabled/playdoh-site.conf":
                 source  => "$PROJ_DIR/puppet/files/etc/httpd/conf.d/playdoh-site.conf",
                 owner   => "root", group => "root", mode => 0644,
-                require => [ Package['apache2-dev'] ];
+                require => [ Package['apache2-dev'], Exec['a2enmod_headers'] ];
             }
             service { "apache2":
                 ensure    => running,
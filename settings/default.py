@@ -117,6 +117,8 @@ MIDDLEWARE_CLASSES = list(base.MIDDLEWARE_CLASSES) + [
     'commonware.response.middleware.GraphiteRequestTimingMiddleware',
     'csp.middleware.CSPMiddleware',
     'phonebook.middleware.PermissionDeniedMiddleware',
+    'common.middleware.IndexCoalescingMiddleware',
+    'common.middleware.UploadSizeMiddleware',
 ]
 
 # StrictTransport
@@ -194,6 +196,11 @@ USERPICS_URL = pre.UPLOAD_URL + '/userpics'
 AUTH_PROFILE_MODULE = 'users.UserProfile'
 
 MAX_PHOTO_UPLOAD_SIZE = 8 * (1024 ** 2)
+#: Photos with more pixels than this are refused without being decoded.
+MAX_PHOTO_PIXELS = 25 * 1000 * 1000
+#: Multipart requests larger than this are refused before they are read.
+MAX_UPLOAD_REQUEST_SIZE = MAX_PHOTO_UPLOAD_SIZE + 256 * 1024
+FILE_UPLOAD_HANDLERS = ('common.uploads.BoundedUploadHandler',)
 
 AUTO_VOUCH_DOMAINS = ('mozilla.com', 'mozilla.org', 'mozillafoundation.org')
 SOUTH_TESTS_MIGRATE = False
@@ -220,5 +227,9 @@ USERNAME_BLACKLIST = ('save', 'tofumatt', 'lonelyvegan', 'tag', 'group',
 THUMBNAIL_DUMMY = True
 THUMBNAIL_PREFIX = 'uploads/sorl-cache/'
 
+# Sizes templates pass to the thumbnail helper.  They are generated ahead of
+# time (see common.thumbnails); list (geometry, options) for sorl options.
+THUMBNAIL_SIZES = ('100x100',)
+
 # This is for the commons/helper.py thumbnail.
 DEFAULT_IMAGE_SRC = path('./media/uploads/unknown.png')